@@ -21,7 +21,7 @@ import warnings
 import numpy as np
 
 from morphomics.cells.soma.soma import Soma
-from morphomics.cells.tree.tree import Tree
+from morphomics.cells.tree.tree import Tree, simplify_trees
 
 DIGIT_TO_TREE_TYPE = {1: "soma", 2: "axon", 3: "basal_dendrite", 4: "apical_dendrite", 5: "glia_process"}
 TREE_TYPE_TO_DIGIT = {"soma": 1, "axon": 2, "basal_dendrite": 3, "apical_dendrite": 4, "glia_process": 5}
@@ -105,16 +105,18 @@ class Neuron:
         """Returns a deep copy of the Neuron."""
         return copy.deepcopy(self)
 
+    def view(self):
+        """Returns a Neuron whose Trees are views on the Trees of this Neuron, see Tree.view.
+        The Soma is shared."""
+        neuron = Neuron(name=self.name, tree_type_dict=self.tree_type_dict)
+        neuron.soma = self.soma
+        for tree_type in ("axon", "apical_dendrite", "basal_dendrite", "glia_process", "undefined"):
+            setattr(neuron, tree_type, [tree.view() for tree in getattr(self, tree_type)])
+        return neuron
+
     def simplify(self):
         """Creates a copy of itself and simplifies all trees to create a skeleton of the neuron."""
-        simplified_neuron = Neuron()
-        simplified_neuron.soma = self.soma.copy_soma()
-
-        for tree in self.neurites:
-            simplified_tree = tree.simplify()
-            simplified_neuron.append_tree(simplified_tree)
-
-        return simplified_neuron
+        return simplify_neurons([self])[0]
     
     def combine_neurites(self):
         """Creates a Neuron that only contains a Tree. 
@@ -155,4 +157,17 @@ class Neuron:
     
 
 
+def simplify_neurons(neurons):
+    """Returns the skeletons of the neurons, the trees of all the neurons are simplified together."""
+    trees = [tree for neuron in neurons for tree in neuron.neurites]
+    simplified_trees = iter(simplify_trees(trees))
+
+    simplified_neurons = []
+    for neuron in neurons:
+        simplified_neuron = Neuron()
+        simplified_neuron.soma = neuron.soma.copy_soma()
+        for _ in neuron.neurites:
+            simplified_neuron.append_tree(next(simplified_trees))
+        simplified_neurons.append(simplified_neuron)
 
+    return simplified_neurons
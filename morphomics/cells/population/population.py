@@ -2,11 +2,31 @@ import warnings
 import numpy as np
 import pandas as pd
 import os
+import time
+from functools import partial
 from morphomics.io.io import read_swc, get_info_frame
 from morphomics.io.swc import swc_to_neuron
-from morphomics.persistent_homology.tmd import get_ph_neuron, get_persistence_diagram
+from morphomics.cells.neuron.neuron import simplify_neurons
+from morphomics.utils import get_nb_workers, parallel_map, restore_nan
+from morphomics.persistent_homology.tmd import get_ph_batch
 from morphomics.view import view
 import matplotlib.pyplot as plt
+
+def _load_cell(file_path, compute_tree = True):
+    """
+    Read a swc file and build its Neuron.
+    Files that fail to load give np.nan instead of raising, so that they end up in the failed files.
+    """
+    try:
+        swc_arr = read_swc(file_path)
+        cell = np.nan
+        if compute_tree and swc_arr is not np.nan:
+            cell = swc_to_neuron(swc_arr)
+    except Exception as e:
+        warnings.warn(f"{file_path} could not be loaded: {e}")
+        swc_arr, cell = np.nan, np.nan
+    return swc_arr, cell
+
 class Population:
     """A Population object is a container for Neurons.
 
@@ -25,10 +45,12 @@ class Population:
                              'Sex' : None,
                              'Animal' : None},
                 extension = ".swc",
-                compute_tree = True
+                compute_tree = True,
+                n_jobs = 1,
                 ):
         """
         Initialize the swc array and the Neuron instance for each sample in the DataFrame.
+        The files are read by n_jobs worker processes (-1 uses all the cpus), the order of the rows is kept.
         """
         # Set name
         if name is None and folder_path is not None:
@@ -55,20 +77,30 @@ class Population:
             assert (
                 "file_path" in info_frame.keys()
             ), "`file_path` must be a column in the info_frame DataFrame"
-            morphoframe = {}
-            # This line returns a warning 
-            info_frame_parts = np.array_split(info_frame, 4)
-            # Potential update
-            # info_frame_parts = [info_frame.iloc[i:i + len(info_frame) // 4] for i in range(0, len(info_frame), len(info_frame) // 4)]
-            for i, sub_info_frame in enumerate(info_frame_parts):
-                # Read the swc files and add them in the column swc_array.
-                sub_info_frame['swc_array'] = sub_info_frame['file_path'].apply(lambda file_path: read_swc(file_path)) 
-                if compute_tree:                       
-                    sub_info_frame['cells'] = sub_info_frame['swc_array'].apply(lambda swc_arr: swc_to_neuron(swc_arr) if swc_arr is not np.nan else np.nan)
-                print("You have loaded %d%% chunk of the data..."%(((i+1)/4)*100))
-                morphoframe[str(i)] = sub_info_frame
-   
-            self.cells = pd.concat([sub_frame for sub_frame in morphoframe.values()], ignore_index=True)
+            file_paths = list(info_frame['file_path'])
+            nb_files = len(file_paths)
+            nb_workers = get_nb_workers(n_jobs)
+            chunksize = max(1, nb_files // (16 * nb_workers))
+            # Print the progress at each quarter of the data
+            checkpoints = set(np.linspace(0, nb_files, 5, dtype=int)[1:])
+            loaded = []
+            start_time = time.time()
+            # Read the swc files, and build the Neuron, with a pool of workers.
+            for loaded_cell in parallel_map(partial(_load_cell, compute_tree = compute_tree), 
+                                            file_paths, 
+                                            n_jobs = nb_workers, 
+                                            chunksize = chunksize):
+                # The failed files come back from the workers as new NaN floats
+                loaded.append(tuple(restore_nan(obj) for obj in loaded_cell))
+                nb_loaded = len(loaded)
+                if nb_loaded in checkpoints:
+                    rate = nb_loaded / max(time.time() - start_time, 1e-9)
+                    print("You have loaded %d%% of the data (%.1f files/s)..."%(100 * nb_loaded / nb_files, rate))
+
+            self.cells = info_frame.copy().reset_index(drop = True)
+            self.cells['swc_array'] = pd.Series([swc_arr for swc_arr, _ in loaded], dtype = object)
+            if compute_tree:
+                self.cells['cells'] = pd.Series([cell for _, cell in loaded], dtype = object)
             print(" ")
 
         # Add cells already in a Panda DataFrame                                            
@@ -91,9 +123,11 @@ class Population:
                                                                 )
         self.set_empty_cells_to_nan()
         
-    def set_barcodes(self, filtration_function = 'radial_distance', from_trees = True):
+    def set_barcodes(self, filtration_function = 'radial_distance', from_trees = True, n_jobs = 1, chunksize = None):
         """
         Calculates persistence diagram of each cell graph.
+        The cells are processed by n_jobs worker processes (-1 uses all the cpus), sent by chunks of chunksize cells.
+        Cells that fail get np.nan as barcode.
         """
         assert filtration_function in ["radial_distance",
                             "path_distance",
@@ -102,18 +136,24 @@ class Population:
         if from_trees:
             if 'trees' not in self.cells.keys():
                 self.combine_neurites()
-            self.cells['barcodes'] = self.cells['trees'].apply(lambda tree: get_persistence_diagram(tree = tree, feature=filtration_function
-                                                                                                ) if tree is not np.nan else np.nan
-                                                                )
+            column = 'trees'
         else:
-            # Assuming self.cells is a Pandas DataFrame
-            self.cells['barcodes'] = self.cells['cells'].apply(lambda cell: get_ph_neuron(neuron = cell, feature=filtration_function
-                                                                                                ) if cell is not np.nan else np.nan)
+            column = 'cells'
+
+        barcodes, errors = get_ph_batch(list(self.cells[column]), 
+                                        feature = filtration_function, 
+                                        n_jobs = n_jobs, 
+                                        chunksize = chunksize)
+        self.cells['barcodes'] = pd.Series(barcodes, index = self.cells.index, dtype = object)
+        if len(errors) > 0:
+            warnings.warn(f"The TMD of {len(errors)} cells failed: {list(errors.values())[:5]}")
     
     def simplify(self):
-        self.cells['simplified_cells'] = self.cells['cells'].apply(lambda cell: cell.simplify()
-                                                                   if cell is not np.nan else np.nan
-                                                                   )
+        """Simplifies all the cells together, the cells that are np.nan stay np.nan."""
+        is_cell = self.cells['cells'].apply(lambda cell: cell is not np.nan)
+        simplified = pd.Series(np.nan, index = self.cells.index, dtype = object)
+        simplified[is_cell] = simplify_neurons(list(self.cells['cells'][is_cell]))
+        self.cells['simplified_cells'] = simplified
         
     def combine_neurites(self):
         self.cells['trees'] = self.cells['cells'].apply(lambda cell: cell.combine_neurites().neurites[0]
@@ -1,11 +1,14 @@
-import copy
 import numpy as np
 from collections import OrderedDict
-from itertools import starmap
-from morphomics.utils import distances
-import scipy.sparse as sp
 from morphomics.cells import utils
 
+def _rows_norm(vectors):
+    """Returns the euclidean norm of each row of vectors.
+    The row-wise dot product gives the same rounding as np.linalg.norm on each row,
+    the array has to be contiguous for matmul to use the same BLAS routine."""
+    vectors = np.ascontiguousarray(vectors)
+    return np.sqrt(np.matmul(vectors[:, None, :], vectors[:, :, None]).reshape(-1))
+
 def size(self):
     """Tree method to get the size of the tree list.
         i.e the number of nodes in the graph (tree).
@@ -38,11 +41,12 @@ def get_type(self):
 # Connectivity features
 def get_children(self):
     """Return a dictionary of children for each node of the tree."""
-    return OrderedDict({i: np.where(self.p == i)[0] for i in range(len(self.p))})
+    children_ptr, children_idx = self.topology.children_ptr, self.topology.children_idx
+    return OrderedDict({i: children_idx[children_ptr[i]:children_ptr[i + 1]] for i in range(len(self.p))})
 
 def get_node_children_number(self):
     """Return number of children per node."""
-    return np.array(sp.csr_matrix.sum(self.dA, axis=0))[0]
+    return self.topology.children_counts.astype(float)
 
 def get_bifurcations(self):
     """Return nodes index that has exactly two children."""
@@ -65,50 +69,33 @@ def get_terminations(self):
 def get_way_to_root(self, node_idx=0):
     """Return way to root. 
     It returns a list of parented nodes from the input node to the root."""
-    way = [node_idx]
-    tmp_id = node_idx
-
-    while tmp_id != -1:
-        way.append(self.p[tmp_id])
-        tmp_id = self.p[tmp_id]
-    # remove -1 at the end of way
-    way.pop()
-    return way
+    return self.topology.way_to_root(node_idx).tolist()
 
 def get_way_length(self, node_idx=0):
-    way = self.get_way_to_root(node_idx)
-    edges_len = self.get_edges_length()
-    way_length = 0
-    for way_idx in way:
-        if way_idx == 0:
-            break
-        # way_idx-1 is the index of the edge length
-        way_length +=  edges_len[way_idx-1]
-    return way_length
+    way = self.topology.way_to_root(node_idx)
+    if len(way) == 1:
+        # The root has no edge, an empty seg_ids would select all the edges
+        return 0
+    # the edge of node i is the edge i-1, the root has no edge
+    edges_len = self.get_edges_length(seg_ids=list(way[:-1] - 1))
+    # cumsum adds the lengths one by one from the node to the root
+    return np.cumsum(edges_len)[-1]
 
 def get_way_order(self, node_idx):
     """Return the number of multifurcation nodes on the way."""
-    multibif_ids = self.get_multifurcations()
-    way_to_root = self.get_way_to_root(node_idx)
-    intersection = set(multibif_ids).intersection(way_to_root)
-    return len(intersection)
+    return self.topology.branch_order[node_idx]
 
 def get_nodes_way_order(self):
     """Return the list of way order.
      This can be also interpreted as an approximation of the number
       of sections between nodes and root."""
-    return np.array([self.get_way_order(i) for i in range(self.size())])
+    return self.topology.branch_order.copy()
 
 def get_all_ways(self):
     # Get all the ways from the root to the leaves
     # The ways
-    way_list = []
     t_tips = self.get_terminations()
-
-    for tip in t_tips:
-        way = self.get_way_to_root(tip)
-        way_list.append(way[::-1])
-    return way_list
+    return [way[::-1].tolist() for way in self.topology.ways_to_root(t_tips)]
 
 # Edges features
 def get_edges_coords(self, seg_ids=None):
@@ -144,9 +131,9 @@ def get_edges_length(self, seg_ids=None):
     if not seg_ids:
         seg_ids = range(0, self.size() - 1)
 
-    segs = self.get_edges_coords(seg_ids)
-
-    seg_len = np.fromiter(starmap(distances['l2'], segs), dtype=float)
+    child_ids = np.asarray(seg_ids, dtype=int) + 1
+    coords = np.transpose([self.x, self.y, self.z])
+    seg_len = _rows_norm(coords[self.p[child_ids]] - coords[child_ids]).astype(float)
 
     return seg_len
 
@@ -169,12 +156,8 @@ def get_lifetime(self, feature="nodes_radial_distance"):
 def get_sections_length(self):
     """Tree method to get section lengths."""
     begs, ends = self.sections
-    sections_len = []
-    for start_idx, end_idx in zip(begs, ends):
-        len_beg_root = self.get_way_length(node_idx = start_idx)
-        len_end_root = self.get_way_length(node_idx = end_idx)
-        section_len = len_end_root - len_beg_root
-        sections_len.append(section_len)
+    path_lengths = self.get_nodes_path_distance()
+    sections_len = list(path_lengths[ends] - path_lengths[begs[:len(ends)]])
     return sections_len
 
 # Angles
@@ -273,28 +256,19 @@ def get_nodes_radial_distance(self, point = None, dim = "xyz"):
     the initial point of the tree- will be used
     as a reference point.
     """
+    coords = np.transpose([getattr(self, d) for d in dim])
     if point is None:
-        point = []
-        for d in dim:
-            point.append(getattr(self, d)[0])
-
-    radial_distances = np.zeros(self.size(), dtype=float)
-
-    for i in range(self.size()):
-        point_dest = []
-        for d in dim:
-            point_dest.append(getattr(self, d)[i])
+        point = coords[0]
 
-        radial_distances[i] = distances['l2'](point, point_dest)
+    radial_distances = _rows_norm(np.subtract(point, coords)).astype(float)
 
     return radial_distances
 
 def get_nodes_path_distance(self):
-    """Tree method to get path distances from the root."""
-    edge_len = self.get_edges_length()
-    path_lengths = np.append(0, copy.deepcopy(edge_len))
-    children = self.get_children()
-    for k, v in children.items():
-        path_lengths[v] = path_lengths[v] + path_lengths[k]
+    """Tree method to get path distances from the root.
+    The edge lengths are accumulated from the root to the leaves, one depth level at a time."""
+    path_lengths = np.append(0, self.get_edges_length())
+    for level in self.topology.levels[1:]:
+        path_lengths[level] = path_lengths[level] + path_lengths[self.p[level]]
 
     return path_lengths
\ No newline at end of file
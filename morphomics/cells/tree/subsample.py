@@ -28,3 +28,32 @@ def cut_branch(self, leaf, degree):
     way = self.get_way_to_root(node_idx = new_leaf)
     way = way[::-1]
     return way
+
+def prune_leaves(self, leaves, nb_nodes, rng=None):
+    """Returns the nodes where the ways of all the leaves stop after removing nb_nodes nodes,
+    or a number of nodes drawn from a geometric distribution for each leaf with the generator rng.
+    Leaves that lose their whole way to the root are dropped."""
+    leaves = np.asarray(leaves, dtype=np.int64)
+    if isinstance(nb_nodes, int):
+        cuts = np.full(len(leaves), nb_nodes)
+    else:
+        cuts = geom.rvs(p=1-nb_nodes, size=len(leaves), random_state=rng) - 1
+    cuts = np.maximum(cuts, 0)
+    depth = self.topology.depth[leaves]
+    kept = cuts <= depth
+    return self.topology.find_ancestors(leaves[kept], depth[kept] - cuts[kept])
+
+def cut_leaves(self, leaves, degree):
+    """Returns the nodes where the ways of all the leaves stop after cutting the sections
+    beyond the degree-th branching node, see cut_branch."""
+    leaves = np.asarray(leaves, dtype=np.int64)
+    topology = self.topology
+    # The section boundaries are the root and the nodes that do not have exactly one child
+    boundaries = topology.children_counts != 1
+    boundaries[0] = True
+    boundary_order = topology.root_path_sums(boundaries)
+    short = boundary_order[leaves] < degree + 1
+    new_leaves = leaves.copy()
+    new_leaves[~short] = topology.find_ancestors(leaves[~short], np.full(np.sum(~short), degree + 1),
+                                                 values=boundary_order, candidates=boundaries)
+    return new_leaves
@@ -0,0 +1,219 @@
+"""Connectivity of a Tree, computed once from its parent array and shared by the tree methods."""
+
+import numpy as np
+from cached_property import cached_property
+
+from morphomics.utils import concatenated_ranges
+
+
+def _levels(roots, children_ptr, children_idx, max_depth):
+    """Returns the nodes reachable from roots grouped by depth, following the CSR children."""
+    levels = []
+    frontier = np.asarray(roots, dtype=np.int64)
+    while len(frontier) > 0 and len(levels) <= max_depth:
+        levels.append(frontier)
+        frontier = children_idx[concatenated_ranges(children_ptr[frontier], children_ptr[frontier + 1])]
+    return levels
+
+
+class TreeTopology:
+    """Topology of a tree: parents, children and sections of its nodes.
+
+    The arrays are computed lazily on first access. The Tree keeps its topology
+    as long as its node arrays are not reassigned, so it is freed with the tree.
+
+    Args:
+        p (np.ndarray): The index of the parent of each node, -1 for the root.
+    """
+
+    def __init__(self, p):
+        self.parents = np.asarray(p)
+        self._parents_children = {}
+
+    def size(self):
+        """Returns the number of nodes."""
+        return len(self.parents)
+
+    @cached_property
+    def children_counts(self):
+        """Returns the number of children of each node."""
+        return np.bincount(self.parents[1:], minlength=self.size())
+
+    @cached_property
+    def children_ptr(self):
+        """Returns the CSR pointers of the children, the children of node i are
+        children_idx[children_ptr[i]:children_ptr[i + 1]]."""
+        return np.concatenate([[0], np.cumsum(self.children_counts)]).astype(np.int64)
+
+    @cached_property
+    def children_idx(self):
+        """Returns the children of all nodes, grouped by parent and in increasing order."""
+        return np.argsort(self.parents[1:], kind="stable") + 1
+
+    def root_path_sums(self, weights):
+        """Returns for each node the sum of the integer weights of the nodes on its way to the root,
+        both included. The ancestors are followed by pointer jumping, doubling the jump length
+        at each step, so the whole tree is done in a logarithmic number of vectorized steps."""
+        sums = np.array(weights, dtype=np.int64)
+        ancestors = self.parents.astype(np.int64)
+        active = np.flatnonzero(ancestors >= 0)
+        for _ in range(int(np.log2(max(self.size(), 1))) + 2):
+            if len(active) == 0:
+                break
+            jumps = ancestors[active]
+            sums[active] += sums[jumps]
+            ancestors[active] = ancestors[jumps]
+            active = active[ancestors[active] >= 0]
+        return sums
+
+    @cached_property
+    def depth(self):
+        """Returns the number of edges between each node and the root."""
+        return self.root_path_sums(np.ones(self.size(), dtype=np.int64)) - 1
+
+    @cached_property
+    def branch_order(self):
+        """Returns the number of multifurcations on the way from each node to the root, both included."""
+        return self.root_path_sums(self.children_counts >= 2)
+
+    @cached_property
+    def subtree_size(self):
+        """Returns the number of nodes of the subtree of each node, itself included."""
+        subtree_size = np.ones(self.size(), dtype=np.int64)
+        for level in self.levels[:0:-1]:
+            np.add.at(subtree_size, self.parents[level], subtree_size[level])
+        return subtree_size
+
+    @cached_property
+    def preorder(self):
+        """Returns the position of each node in a depth first traversal visiting the children in
+        increasing order. The subtree of node i is made of the nodes j with
+        preorder[i] <= preorder[j] < preorder[i] + subtree_size[i]."""
+        sizes = self.subtree_size[self.children_idx]
+        cumsizes = np.concatenate([[0], np.cumsum(sizes)])
+        counts = np.diff(self.children_ptr)
+        # Position of each child relative to its parent: 1 + the sizes of its previous siblings
+        offsets = np.zeros(self.size(), dtype=np.int64)
+        offsets[self.children_idx] = 1 + cumsizes[:-1] - np.repeat(cumsizes[self.children_ptr[:-1]], counts)
+        return self.root_path_sums(offsets)
+
+    def way_to_root(self, node_idx):
+        """Returns the nodes from node_idx to the root, the ancestors found with the preorder intervals."""
+        position = self.preorder[node_idx]
+        ancestors = np.flatnonzero((self.preorder <= position) & (position < self.preorder + self.subtree_size))
+        return ancestors[np.argsort(self.depth[ancestors])[::-1]]
+
+    def find_ancestors(self, node_ids, targets, values=None, candidates=None):
+        """Returns for each node of node_ids its ancestor u, the node itself included, with values[u] == target.
+
+        The values must increase strictly from the root to the leaves among the candidate nodes.
+        By default they are the depths and all the nodes are candidates, i.e. the ancestors
+        targets edges below the root. The candidates are sorted by (value, preorder) so that the
+        ancestor is the last candidate with the target value that comes before the node.
+        """
+        values = self.depth if values is None else np.asarray(values, dtype=np.int64)
+        candidates = np.arange(self.size()) if candidates is None else np.flatnonzero(candidates)
+        keys = values[candidates] * self.size() + self.preorder[candidates]
+        order = np.argsort(keys)
+        queries = np.asarray(targets, dtype=np.int64) * self.size() + self.preorder[node_ids]
+        return candidates[order][np.searchsorted(keys[order], queries, side="right") - 1]
+
+    def ancestors_mask(self, node_ids):
+        """Returns the mask of the nodes that are ancestors of at least one of node_ids, these included.
+        A node is kept if one of node_ids falls in its preorder interval."""
+        positions = np.sort(self.preorder[np.asarray(node_ids, dtype=np.int64)])
+        first = np.searchsorted(positions, self.preorder)
+        last = np.searchsorted(positions, self.preorder + self.subtree_size)
+        return last > first
+
+    def ways_to_root(self, node_ids):
+        """Returns the ways from each of the node_ids to the root, all nodes climbing together."""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        lengths = self.depth[node_ids] + 1
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        ways = np.empty(offsets[-1], dtype=np.int64)
+        current, positions = node_ids.copy(), offsets[:-1].copy()
+        while len(current) > 0:
+            ways[positions] = current
+            current, positions = self.parents[current], positions + 1
+            climbing = current >= 0
+            current, positions = current[climbing], positions[climbing]
+        return np.split(ways, offsets[1:-1])
+
+    @cached_property
+    def topological_order(self):
+        """Returns the nodes sorted by depth, each parent comes before its children."""
+        return np.argsort(self.depth, kind="stable")
+
+    @cached_property
+    def levels(self):
+        """Returns the nodes grouped by depth, from the root to the deepest leaves."""
+        offsets = np.cumsum(np.bincount(self.depth))[:-1]
+        return np.split(self.topological_order, offsets)
+
+    @cached_property
+    def sections(self):
+        """Returns the parents of the first sections' points and their last points."""
+        end = np.array(self.children_counts != 1).nonzero()[0]
+        if 0 in end:  # If first segment is a bifurcation
+            end = end[1:]
+
+        beg = np.append([0], self.parents[np.delete(np.hstack([0, 1 + end]), len(end))][1:])
+        return beg, end
+
+    @cached_property
+    def section_graph(self):
+        """Returns the graph of the sections as flat arrays.
+
+        Returns:
+            children_ptr (np.ndarray): (n + 1,) the section children of node i are
+                children_idx[children_ptr[i]:children_ptr[i + 1]], in increasing order.
+            children_idx (np.ndarray): the ends of the sections sorted by their starting node.
+            component_ids (np.ndarray): (n,) the first section starting at node i, 0 if there is none.
+            levels (list[np.ndarray]): the section nodes grouped by depth from the root.
+        """
+        n = self.size()
+        beg, end = self.sections
+        # A single node tree has no section but beg is [0]
+        beg, end = np.asarray(beg[:len(end)], dtype=np.int64), np.asarray(end, dtype=np.int64)
+
+        sec_order = np.argsort(beg, kind="stable")
+        children_ptr = np.searchsorted(beg[sec_order], np.arange(n + 1))
+        children_idx = end[sec_order]
+        component_ids = np.zeros(n, dtype=np.int64)
+        has_children = children_ptr[1:] > children_ptr[:-1]
+        component_ids[has_children] = sec_order[children_ptr[:-1][has_children]]
+
+        levels = _levels([0], children_ptr, children_idx, n)
+        return children_ptr, children_idx, component_ids, levels
+
+    @cached_property
+    def edges(self):
+        """Returns the parents and children nodes of each edge."""
+        return self.parents[1:], np.arange(1, self.size())
+
+    def parents_children(self, edges=False):
+        """Returns the dictionnaries of children to parents and parents to children,
+        of the sections or of the edges. They are computed once per topology."""
+        if edges not in self._parents_children:
+            begs, ends = self.edges if edges else self.sections
+            self._parents_children[edges] = self._group_children(begs, ends)
+        return self._parents_children[edges]
+
+    def _group_children(self, begs, ends):
+        if self.size() == 1:
+            return {}, {}
+
+        children_to_parents = {e: b for b, e in zip(begs, ends)}
+
+        if 0 in begs:
+            children_to_parents[0] = self.parents[0]
+
+        # One stable sort keeps the children of each parent in their original order
+        order = np.argsort(begs, kind="stable")
+        sorted_begs = begs[order]
+        splits = np.flatnonzero(np.diff(sorted_begs)) + 1
+        keys = sorted_begs[np.append(0, splits)] if len(sorted_begs) > 0 else sorted_begs
+        parents_to_children = dict(zip(keys, np.split(ends[order], splits)))
+
+        return children_to_parents, parents_to_children
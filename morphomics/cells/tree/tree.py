@@ -20,7 +20,12 @@ import copy
 import numpy as np
 import scipy.sparse as sp
 from cached_property import cached_property
-from functools import lru_cache
+
+from morphomics.cells.tree.topology import TreeTopology
+
+# Reassigning one of these arrays drops the cached topology of the tree
+TOPOLOGY_ATTRIBUTES = ("x", "y", "z", "p")
+CACHED_ATTRIBUTES = ("_topology", "dA")
 
 class Tree:
     """Tree class.
@@ -32,6 +37,8 @@ class Tree:
         d (list[float]): The diameters of the tree segments.
         t (list[int]): The types (basal_dendrite, apical_dendrite, axon) of the tree segments.
         p (list[int]): The index of the parent of the tree segments.
+        copy (bool): If False, arrays that already have the right dtype are used as they are instead of
+            being copied, e.g. the memory-mapped views of a MorphoStore.
     """
 
     # pylint: disable=import-outside-toplevel
@@ -71,16 +78,19 @@ class Tree:
 
     from morphomics.cells.tree.subsample import prune_branch
     from morphomics.cells.tree.subsample import cut_branch
+    from morphomics.cells.tree.subsample import prune_leaves
+    from morphomics.cells.tree.subsample import cut_leaves
 
-    def __init__(self, x, y, z, d, t, p):
+    def __init__(self, x, y, z, d, t, p, copy=True):
         """Constructor of tmd Tree Object."""
+        _array = np.array if copy else np.asarray
         try:
-            self.x = np.array(x, dtype=np.float32)
-            self.y = np.array(y, dtype=np.float32)
-            self.z = np.array(z, dtype=np.float32)
-            self.d = np.array(d, dtype=np.float32)
-            self.t = np.array(t, dtype=np.int32)
-            self.p = np.array(p, dtype=np.int64)
+            self.x = _array(x, dtype=np.float32)
+            self.y = _array(y, dtype=np.float32)
+            self.z = _array(z, dtype=np.float32)
+            self.d = _array(d, dtype=np.float32)
+            self.t = _array(t, dtype=np.int32)
+            self.p = _array(p, dtype=np.int64)
             # Check if all arrays have the same length
             lengths = [len(self.x), len(self.y), len(self.z), len(self.d), len(self.t), len(self.p)]
             if not all(length == lengths[0] for length in lengths):
@@ -88,7 +98,36 @@ class Tree:
         except ValueError as e:
             print(e)
 
-        self.dA = sp.csr_matrix(
+    def __setattr__(self, name, value):
+        if name in TOPOLOGY_ATTRIBUTES:
+            self.clear_cache()
+        super().__setattr__(name, value)
+
+    def __getstate__(self):
+        """The cached topology is not pickled, it is recomputed when needed."""
+        state = self.__dict__.copy()
+        for name in CACHED_ATTRIBUTES + ("edges", "sections"):
+            state.pop(name, None)
+        return state
+
+    def clear_cache(self):
+        """Drops the cached topology, e.g. after modifying the node arrays in place."""
+        for name in CACHED_ATTRIBUTES:
+            self.__dict__.pop(name, None)
+
+    @property
+    def topology(self):
+        """Returns the TreeTopology of the tree, computed once and kept with the tree."""
+        topology = self.__dict__.get("_topology")
+        if topology is None:
+            topology = TreeTopology(self.p)
+            self.__dict__["_topology"] = topology
+        return topology
+
+    @cached_property
+    def dA(self):
+        """Returns the adjacency matrix of the tree, child to parent."""
+        return sp.csr_matrix(
             (np.ones(len(self.x) - 1), (range(1, len(self.x)), self.p[1:])),
             shape=(len(self.x), len(self.x)),
         )
@@ -96,6 +135,20 @@ class Tree:
     def copy_tree(self):
         """Returns a deep copy of the Tree."""
         return copy.deepcopy(self)
+
+    def view(self):
+        """Returns a Tree that shares the node arrays and the cached topology of this Tree.
+
+        The arrays of the view are read-only so that they cannot be modified in place. Methods
+        that change a tree reassign its arrays (e.g. move_to_point), which only affects the view.
+        """
+        tree = Tree.__new__(Tree)
+        for col in "xyzdtp":
+            arr = getattr(self, col).view()
+            arr.flags.writeable = False
+            setattr(tree, col, arr)
+        tree.__dict__["_topology"] = self.topology
+        return tree
     
     def is_equal(self, tree):
         """Tests if all tree lists are the same."""
@@ -113,7 +166,7 @@ class Tree:
         )
         return eq
     
-    @cached_property
+    @property
     def edges(self):
         """Returns the parents and children nodes of each edge.
 
@@ -124,12 +177,9 @@ class Tree:
                 children (np.ndarray)
                     The ending point ids of edges
         """
-        parents = self.p[1:]
-        children = np.array(range(1, self.size()))        
-        
-        return parents, children
+        return self.topology.edges
     
-    @cached_property
+    @property
     def sections(self):
         """Get the sections boundaries of the current tree.
         A section is a subset of the tree where each node has only one child, excepeted the boundaries.
@@ -142,16 +192,8 @@ class Tree:
                 section_end_point_ids (np.ndarray)
                     The ending point ids of sections
         """
-        """Get indices of the parents of the first sections' points and of their last points."""
-        children_counts = self.get_node_children_number() 
-        end = np.array(children_counts != 1).nonzero()[0]
-        if 0 in end:  # If first segment is a bifurcation
-            end = end[1:]
-
-        beg = np.append([0], self.p[np.delete(np.hstack([0, 1 + end]), len(end))][1:])
-        return beg, end
+        return self.topology.sections
     
-    @lru_cache(maxsize=None)  # This decorator caches the results
     def parents_children(self, edges=False):
         """Returns the dictionnaries of parents to children and children to parents.
 
@@ -162,23 +204,10 @@ class Tree:
                 and the respective values to the children section ids (nodes)
 
         Notes:
-            If 0 exists in starting nodes, the parent from tree is assigned
+            If 0 exists in starting nodes, the parent from tree is assigned.
+            The dictionnaries are cached in the topology of the tree, they must not be modified.
         """
-        if len(self.p) == 1:
-            return {}, {}
-        if edges:
-            begs, ends = self.edges
-        else:
-            begs, ends = self.sections
-
-        children_to_parents = {e: b for b, e in zip(begs, ends)}
-
-        if 0 in begs:
-            children_to_parents[0] = self.p[0]
-
-        parents_to_children = {b: ends[np.where(begs == b)[0]] for b in np.unique(begs)}
-
-        return children_to_parents, parents_to_children
+        return self.topology.parents_children(edges)
     
     def move_to_point(self, point=(0, 0, 0)):
         """Moves the tree in the x-y-z plane so that it starts from the selected point."""
@@ -195,68 +224,69 @@ class Tree:
 
     def simplify(self):
         """Returns a simplified tree that corresponds to the start - end of the sections points."""
-        if self.size() == 1:
-            return self
-         
-        beg0, end0 = self.sections
-        sections = np.transpose([beg0, end0])
-
-        x = np.zeros([len(sections) + 1])
-        y = np.zeros([len(sections) + 1])
-        z = np.zeros([len(sections) + 1])
-        d = np.zeros([len(sections) + 1])
-        t = np.zeros([len(sections) + 1])
-        p = np.zeros([len(sections) + 1])
-
-        x[0] = self.x[sections[0][0]]
-        y[0] = self.y[sections[0][0]]
-        z[0] = self.z[sections[0][0]]
-        d[0] = self.d[sections[0][0]]
-        t[0] = self.t[sections[0][0]]
-        p[0] = -1
-
-        for i, s in enumerate(sections):
-            x[i + 1] = self.x[s[1]]
-            y[i + 1] = self.y[s[1]]
-            z[i + 1] = self.z[s[1]]
-            d[i + 1] = self.d[s[1]]
-            t[i + 1] = self.t[s[1]]
-            p[i + 1] = np.where(beg0 == s[0])[0][0]
-
-        return Tree(x, y, z, d, t, p)
+        return simplify_trees([self])[0]
     
     # def simplify(self):
     #     """Returns a simplified tree that corresponds to the start - end of the sections points."""
     #     k_out = self.get_node_children_number()
 
-    def subsample_tree(self, _type, number):
+    def subsample_tree(self, _type, number, rng=None):
+        """Returns the tree made of the ways to the root of the pruned or cut leaves, None if only the root is left.
+        The kept nodes are marked with a mask over the nodes and the parents renumbered with their rank.
+        The random prunings are drawn with the generator rng, the global random state if None."""
         tip_starts = self.get_terminations()
-        subsampled_nodes = set()
-        for leaf in tip_starts:
-            if _type == 'cut':
-                way = self.cut_branch(leaf, degree = number)
-            elif _type == 'prune':
-                way = self.prune_branch(leaf, nb_nodes = number)
-            subsampled_nodes.update(way)
-        subsampled_nodes = list(subsampled_nodes)
-        subsampled_nodes = sorted(subsampled_nodes)
-
-        if len(subsampled_nodes) == 0:
-            subsampled_nodes = [0]
-        new_x = self.x[subsampled_nodes]
-        new_y = self.y[subsampled_nodes]
-        new_z = self.z[subsampled_nodes]
-        new_d = self.d[subsampled_nodes]
-        new_t = self.t[subsampled_nodes]
-        new_p = self.p[subsampled_nodes]
-
-        # Step 1: Create a mapping of nodes to their indices in subsampled_nodes
-        index_map = {node: index for index, node in enumerate(subsampled_nodes)}
-        index_map[-1] = -1
-        # Step 2: Replace each number in list p with its index from subsampled_nodes
-        new_p = [index_map[number] for number in new_p]
+        if _type == 'cut':
+            new_leaves = self.cut_leaves(tip_starts, degree = number)
+        elif _type == 'prune':
+            new_leaves = self.prune_leaves(tip_starts, nb_nodes = number, rng = rng)
+
+        kept = self.topology.ancestors_mask(new_leaves)
+        kept[0] = kept[0] or not np.any(kept)
+        subsampled_nodes = np.flatnonzero(kept)
+
         if len(subsampled_nodes) > 1:
-            new_tree = Tree(new_x, new_y, new_z, new_d, new_t, new_p)
+            # The parents of kept nodes are kept, their new index is their rank among the kept nodes
+            rank = np.cumsum(kept) - 1
+            new_p = self.p[subsampled_nodes]
+            new_p = np.where(new_p >= 0, rank[new_p], -1)
+            new_tree = Tree(self.x[subsampled_nodes], self.y[subsampled_nodes], self.z[subsampled_nodes],
+                            self.d[subsampled_nodes], self.t[subsampled_nodes], new_p)
             return new_tree
         else:
-            return None
\ No newline at end of file
+            return None
+
+
+def simplify_trees(trees):
+    """Returns the simplified trees, that correspond to the start - end of the sections points.
+
+    The sections of all the trees are gathered in flat arrays and the simplified node arrays
+    are built at once with index lookups. Trees made of a single node are returned as they are.
+    """
+    simplified = list(trees)
+    to_simplify = [i for i, tree in enumerate(trees) if tree.size() > 1]
+    if len(to_simplify) == 0:
+        return simplified
+    trees = [trees[i] for i in to_simplify]
+
+    node_offsets = np.concatenate([[0], np.cumsum([tree.size() for tree in trees])])
+    sections = [tree.sections for tree in trees]
+    nb_sections = np.array([len(end) for _, end in sections], dtype=np.int64)
+    section_offsets = np.concatenate([[0], np.cumsum(nb_sections)])
+    tree_ids = np.repeat(np.arange(len(trees)), nb_sections)
+    begs = np.concatenate([beg for beg, _ in sections]) + node_offsets[tree_ids]
+    ends = np.concatenate([end for _, end in sections]) + node_offsets[tree_ids]
+
+    # The parent of a section is the first section of the tree starting at the same node
+    order = np.argsort(begs, kind="stable")
+    first_sections = order[np.searchsorted(begs[order], begs)] - section_offsets[tree_ids]
+
+    # Each simplified tree is the first section start followed by all the section ends
+    starts = begs[section_offsets[:-1]]
+    nodes = np.insert(ends, section_offsets[:-1], starts)
+    parents = np.insert(first_sections, section_offsets[:-1], -1)
+
+    new_offsets = section_offsets + np.arange(len(trees) + 1)
+    columns = {col: np.concatenate([getattr(tree, col) for tree in trees])[nodes] for col in "xyzdt"}
+    for i, beg, end in zip(to_simplify, new_offsets[:-1], new_offsets[1:]):
+        simplified[i] = Tree(*[columns[col][beg:end] for col in "xyzdt"], parents[beg:end])
+    return simplified
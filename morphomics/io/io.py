@@ -5,11 +5,12 @@ about reading and writing files.
 from __future__ import print_function
 
 import os, glob
+import warnings
 import numpy as np
-import re
 import pandas as pd
 import pickle as pkl
 
+from itertools import chain, compress
 from operator import itemgetter
 from morphomics.io.swc import SWC_DCT
 from morphomics.cells.utils import LoadSWCError
@@ -18,8 +19,42 @@ from morphomics.cells.utils import LoadSWCError
 # https://github.com/BlueBrain/TMD
 
 
+def _parse_swc_tokens(tokens):
+    """Convert tokenized swc data lines at once into a (N, 7) float array.
+
+    Returns the parsed array and the positions in `tokens` of the lines
+    that do not hold exactly seven finite numbers.
+    """
+    n_cols = len(SWC_DCT)
+    n_tokens = np.fromiter(map(len, tokens), dtype=int, count=len(tokens))
+    well_formed = n_tokens == n_cols
+    try:
+        values = np.array(
+            list(chain.from_iterable(compress(tokens, well_formed))), dtype=float
+        ).reshape(-1, n_cols)
+    except ValueError:
+        # Some token is not a number, fall back to converting line by line
+        rows = []
+        for i in np.where(well_formed)[0]:
+            try:
+                rows.append(np.array(tokens[i], dtype=float))
+            except ValueError:
+                well_formed[i] = False
+        values = np.array(rows, dtype=float).reshape(-1, n_cols)
+
+    # nan and inf are parsed by numpy but are not valid swc entries
+    finite = np.isfinite(values).all(axis=1)
+    well_formed[np.where(well_formed)[0][~finite]] = False
+    return values[finite], np.where(~well_formed)[0]
+
+
 def read_swc(file_path, line_delimiter="\n"):
-    """Load a swc file containing a list of sections, into a numpy.array format."""
+    """Load a swc file containing a list of sections, into a numpy.array format.
+
+    The whole file is tokenized in bulk. Lines containing "#" and empty lines are ignored,
+    lines that do not hold exactly seven numbers are skipped with a warning.
+    Radii are converted to diameters. Returns np.nan if the file has less than two data lines.
+    """
     # Read all data from file.
     try:
         assert file_path.endswith((".swc"))
@@ -27,41 +62,32 @@ def read_swc(file_path, line_delimiter="\n"):
         raise Warning("{} is not a valid swc file".format(file_path))
     except LoadSWCError:
         return np.nan
-    
+
     with open(file_path, "r", encoding="utf-8") as f:
         read_data = f.read()
 
-    # Split data per lines
+    # Split data per lines and tokenize them, comments are treated as empty lines
     split_data = read_data.split(line_delimiter)
-    # Clean data from comments and empty lines
-    split_data = [a for a in split_data if "#" not in a]
-    split_data = [a for a in split_data if a != ""]
-    if len(split_data) < 2:
+    tokens = [a.split() if "#" not in a else [] for a in split_data]
+    # Clean data from comments and empty lines, keep the line numbers to report the skipped ones
+    line_numbers = [i + 1 for i, a in enumerate(tokens) if a]
+    tokens = [a for a in tokens if a]
+    if len(tokens) < 2:
         return np.nan
-    split_data = np.array(split_data)
 
     """Transform swc to np.array to be used in make_tree."""
-    expected_data = re.compile(
-        r"^\s*([-+]?\d*\.\d+|[-+]?\d+)"
-        r"\s*([-+]?\d*\.\d+|[-+]?\d+)\s"
-        r"*([-+]?\d*\.\d+|[-+]?\d+)\s*"
-        r"([-+]?\d*\.\d+|[-+]?\d+)\s*"
-        r"([-+]?\d*\.\d+|[-+]?\d+)\s*"
-        r"([-+]?\d*\.\d+|[-+]?\d+)\s*"
-        r"([-+]?\d*\.\d+|[-+]?\d+)\s*$"
-    )
-
-    data = []
-    for dpoint in split_data:
-        if expected_data.match(dpoint.replace("\r", "")):
-            segment_point = np.array(
-                expected_data.match(dpoint.replace("\r", "")).groups(), dtype=float
+    swc_arr, bad_lines = _parse_swc_tokens(tokens)
+    if len(bad_lines) > 0:
+        warnings.warn(
+            "{}: skipped {} malformed line(s) {}".format(
+                file_path, len(bad_lines), [line_numbers[i] for i in bad_lines]
             )
-            # make the radius diameter
-            segment_point[SWC_DCT["radius"]] = 2.0 * segment_point[SWC_DCT["radius"]]
+        )
+    if len(swc_arr) == 0:
+        return np.nan
 
-            data.append(segment_point)
-    swc_arr = np.array(data)
+    # make the radius diameter
+    swc_arr[:, SWC_DCT["radius"]] = 2.0 * swc_arr[:, SWC_DCT["radius"]]
     return swc_arr
 
 def save_fig_pdf(fig, filepath):
@@ -0,0 +1,240 @@
+"""
+Python module that contains the columnar on-disk store of morphoframes.
+
+Instead of pickling the Neuron, Tree and Soma objects of each cell,
+the node arrays of all the trees are concatenated column by column (x, y, z, d, t, p)
+and saved as .npy files together with the offsets of each tree and of each cell.
+The other columns of the morphoframe are saved in a metadata table.
+When loading, the .npy files are memory-mapped and the Trees are views on them,
+built only when a cell is accessed.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from morphomics.io.io import save_obj, load_obj
+from morphomics.cells.neuron.neuron import Neuron, DIGIT_TO_TREE_TYPE
+from morphomics.cells.soma.soma import Soma
+from morphomics.cells.tree.tree import Tree
+
+STORE_EXTENSION = ".morpho"
+
+# Columns of the node arrays and their dtype, the same as in Tree
+TREE_COLUMNS = {"x": np.float32, "y": np.float32, "z": np.float32, "d": np.float32, "t": np.int32, "p": np.int64}
+SOMA_COLUMNS = {"x": np.float64, "y": np.float64, "z": np.float64, "d": np.float64}
+
+
+def is_morphostore(filepath):
+    """Returns True if filepath points to a morphoframe saved with save_morphoframe."""
+    return str(filepath).endswith(STORE_EXTENSION) and os.path.isdir(filepath)
+
+
+def _offsets(sizes):
+    """Returns the offsets of consecutive blocks with the given sizes."""
+    return np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64)
+
+
+def _concatenate(arrays, dtype, shape=(0,)):
+    if len(arrays) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def save_morphoframe(morphoframe, filepath, cells_column="cells", swc_column="swc_array"):
+    """Save a morphoframe in the columnar store.
+
+    Args:
+        morphoframe (DataFrame): each row is a cell, `cells_column` contains Neuron instances or np.nan.
+        filepath (str): path of the store, STORE_EXTENSION is appended if missing.
+        cells_column (str): column containing the Neurons.
+        swc_column (str): column containing the swc arrays, it is optional.
+
+    Returns:
+        filepath (str): the path of the store.
+    """
+    if not filepath.endswith(STORE_EXTENSION):
+        filepath = filepath + STORE_EXTENSION
+    os.makedirs(filepath, exist_ok=True)
+
+    cells = list(morphoframe[cells_column]) if cells_column in morphoframe.columns else []
+    trees, cell_nb_trees, cell_valid, cell_names, tree_type_dicts = [], [], [], [], []
+    somata = []
+    for cell in cells:
+        if isinstance(cell, Neuron):
+            cell_trees = cell.neurites + cell.undefined
+            trees.extend(cell_trees)
+            cell_nb_trees.append(len(cell_trees))
+            somata.append(cell.soma)
+            cell_valid.append(True)
+            cell_names.append(cell.name)
+            tree_type_dicts.append(cell.tree_type_dict)
+        elif cell is None or (isinstance(cell, float) and np.isnan(cell)):
+            cell_nb_trees.append(0)
+            somata.append(Soma())
+            cell_valid.append(False)
+            cell_names.append(None)
+            tree_type_dicts.append(None)
+        else:
+            raise TypeError("Items in %s must be Neuron instances or np.nan, not %s" % (cells_column, type(cell)))
+
+    for col, dtype in TREE_COLUMNS.items():
+        np.save(os.path.join(filepath, "tree_%s.npy" % col),
+                _concatenate([getattr(tree, col) for tree in trees], dtype))
+    np.save(os.path.join(filepath, "tree_offsets.npy"), _offsets([len(tree.x) for tree in trees]))
+    np.save(os.path.join(filepath, "cell_tree_offsets.npy"), _offsets(cell_nb_trees))
+    np.save(os.path.join(filepath, "cell_valid.npy"), np.array(cell_valid, dtype=bool))
+    for col, dtype in SOMA_COLUMNS.items():
+        np.save(os.path.join(filepath, "soma_%s.npy" % col),
+                _concatenate([getattr(soma, col) for soma in somata], dtype))
+    np.save(os.path.join(filepath, "soma_offsets.npy"), _offsets([len(soma.x) for soma in somata]))
+
+    has_swc = swc_column in morphoframe.columns
+    if has_swc:
+        swc_arrays = list(morphoframe[swc_column])
+        swc_valid = np.array([isinstance(swc_arr, np.ndarray) for swc_arr in swc_arrays], dtype=bool)
+        swc_arrays = [swc_arr if valid else np.zeros((0, 7)) for swc_arr, valid in zip(swc_arrays, swc_valid)]
+        np.save(os.path.join(filepath, "swc.npy"), _concatenate(swc_arrays, np.float64, shape=(0, 7)))
+        np.save(os.path.join(filepath, "swc_offsets.npy"), _offsets([len(swc_arr) for swc_arr in swc_arrays]))
+        np.save(os.path.join(filepath, "swc_valid.npy"), swc_valid)
+
+    metadata = {"frame": morphoframe.drop(columns=[c for c in (cells_column, swc_column) if c in morphoframe.columns]),
+                "columns": list(morphoframe.columns),
+                "cells_column": cells_column if cells_column in morphoframe.columns else None,
+                "swc_column": swc_column if has_swc else None,
+                "cell_names": cell_names,
+                # The cells usually share one dict, which is pickled once
+                "tree_type_dicts": tree_type_dicts,
+                }
+    save_obj(metadata, os.path.join(filepath, "metadata"))
+    return filepath
+
+
+class MorphoStore:
+    """Read access to a morphoframe saved with save_morphoframe.
+
+    The node arrays are memory-mapped, the Trees, Neurons and swc arrays are rebuilt
+    on demand as views on them without copying. Indexing the store or iterating over it
+    builds one Neuron at a time, to_morphoframe builds the Neurons of all the cells.
+
+    Args:
+        filepath (str): path of the store.
+        mmap_mode (str): mode used by np.load to memory-map the arrays, None loads them in memory.
+    """
+    def __init__(self, filepath, mmap_mode="r"):
+        if not filepath.endswith(STORE_EXTENSION):
+            filepath = filepath + STORE_EXTENSION
+        self.filepath = filepath
+        self.metadata = load_obj(os.path.join(filepath, "metadata"))
+
+        # np.asarray keeps the memory-map but makes slicing as cheap as for an ndarray
+        _load = lambda name: np.asarray(np.load(os.path.join(filepath, name + ".npy"), mmap_mode=mmap_mode))
+        self.tree_columns = {col: _load("tree_%s" % col) for col in TREE_COLUMNS}
+        self.tree_offsets = _load("tree_offsets")
+        self.cell_tree_offsets = _load("cell_tree_offsets")
+        self.cell_valid = _load("cell_valid")
+        self.soma_columns = {col: _load("soma_%s" % col) for col in SOMA_COLUMNS}
+        self.soma_offsets = _load("soma_offsets")
+        if self.metadata["swc_column"] is not None:
+            self.swc = _load("swc")
+            self.swc_offsets = _load("swc_offsets")
+            self.swc_valid = _load("swc_valid")
+
+    def __len__(self):
+        return len(self.metadata["frame"])
+
+    def __getitem__(self, cell_idx):
+        """Returns the Neuron of the cell cell_idx, built on access."""
+        return self.get_neuron(cell_idx)
+
+    def __iter__(self):
+        """Yields the Neuron of each cell, built one at a time."""
+        for cell_idx in range(len(self)):
+            yield self.get_neuron(cell_idx)
+
+    def get_tree(self, tree_idx):
+        """Returns the Tree tree_idx, its node arrays are views on the store."""
+        beg, end = self.tree_offsets[tree_idx], self.tree_offsets[tree_idx + 1]
+        return Tree(**{col: arr[beg:end] for col, arr in self.tree_columns.items()}, copy=False)
+
+    def get_neuron(self, cell_idx):
+        """Returns the Neuron of the cell cell_idx, or np.nan if the cell failed to load."""
+        if not self.cell_valid[cell_idx]:
+            return np.nan
+        # Stores saved before the tree types were kept use the default types
+        tree_type_dicts = self.metadata.get("tree_type_dicts")
+        tree_type_dict = tree_type_dicts[cell_idx] if tree_type_dicts is not None else DIGIT_TO_TREE_TYPE
+        neuron = Neuron(name=self.metadata["cell_names"][cell_idx], tree_type_dict=tree_type_dict)
+        beg, end = self.soma_offsets[cell_idx], self.soma_offsets[cell_idx + 1]
+        neuron.set_soma(Soma(**{col: arr[beg:end] for col, arr in self.soma_columns.items()}))
+        for tree_idx in range(self.cell_tree_offsets[cell_idx], self.cell_tree_offsets[cell_idx + 1]):
+            neuron.append_tree(self.get_tree(tree_idx))
+        return neuron
+
+    def get_swc_array(self, cell_idx):
+        """Returns the swc array of the cell cell_idx, or np.nan if the file failed to load."""
+        if not self.swc_valid[cell_idx]:
+            return np.nan
+        return self.swc[self.swc_offsets[cell_idx]:self.swc_offsets[cell_idx + 1]]
+
+    def get_row(self, cell_idx):
+        """Returns the row cell_idx of the morphoframe, only its cell is built."""
+        row = self.metadata["frame"].iloc[cell_idx].copy()
+        if self.metadata["swc_column"] is not None:
+            row[self.metadata["swc_column"]] = self.get_swc_array(cell_idx)
+        if self.metadata["cells_column"] is not None:
+            row[self.metadata["cells_column"]] = self.get_neuron(cell_idx)
+        return row[self.metadata["columns"]]
+
+    def to_morphoframe(self, columns=None):
+        """Returns the morphoframe, with the columns in their saved order.
+
+        Only the columns in columns are returned, all of them if None. The Neurons of all the cells
+        are built if the cells column is requested, use the store accessors to build them one at a time.
+        """
+        columns = self.metadata["columns"] if columns is None else [c for c in self.metadata["columns"] if c in columns]
+        cells_column = self.metadata["cells_column"]
+        swc_column = self.metadata["swc_column"]
+        morphoframe = self.metadata["frame"][[c for c in columns if c not in (cells_column, swc_column)]].copy()
+        if swc_column in columns:
+            morphoframe[swc_column] = pd.Series([self.get_swc_array(i) for i in range(len(self))],
+                                                index=morphoframe.index, dtype=object)
+        if cells_column in columns:
+            morphoframe[cells_column] = pd.Series(list(self), index=morphoframe.index, dtype=object)
+        return morphoframe[columns]
+
+
+def load_morphoframe(filepath, mmap_mode="r", columns=None):
+    """Load a morphoframe saved with save_morphoframe, the node arrays are memory-mapped.
+    Only the columns in columns are loaded, all of them if None."""
+    return MorphoStore(filepath, mmap_mode=mmap_mode).to_morphoframe(columns=columns)
+
+
+def save_vectors(vectors, filepath, dtype=np.float32):
+    """Save row vectors in a .npy file that can be memory-mapped, e.g. by DimReducer.
+
+    The file is allocated once and filled row by row, so the vectors can be a sequence of
+    rows, like a morphoframe column, without stacking them in memory.
+
+    Args:
+        vectors (sequence of np.array): the row vectors, all of the same length.
+        filepath (str): path of the .npy file.
+        dtype (np.dtype): dtype of the saved vectors.
+
+    Returns:
+        filepath (str): the path of the .npy file.
+    """
+    if not filepath.endswith(".npy"):
+        filepath = filepath + ".npy"
+    nb_features = len(np.ravel(vectors[0])) if len(vectors) > 0 else 0
+    store = np.lib.format.open_memmap(filepath, mode="w+", dtype=dtype, shape=(len(vectors), nb_features))
+    for row, vector in enumerate(vectors):
+        store[row] = np.ravel(vector)
+    store.flush()
+    del store
+    return filepath
+
+
+def load_vectors(filepath, mmap_mode="r"):
+    """Load row vectors saved with save_vectors, memory-mapped."""
+    return np.load(filepath, mmap_mode=mmap_mode)
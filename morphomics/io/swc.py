@@ -13,14 +13,25 @@ from morphomics.cells.utils import LoadNeuronError
 # Definition of swc data container
 SWC_DCT = {"index": 0, "type": 1, "x": 2, "y": 3, "z": 4, "radius": 5, "parent": 6}
 
+def _parent_rows(ids, parent_ids):
+    """Map each parent ID to the row holding that ID, -1 if there is none.
+
+    IDs are sorted once and all parents are looked up with a single binary search,
+    instead of scanning the IDs for every node. Duplicated IDs resolve to their first row.
+    """
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    pos = np.searchsorted(sorted_ids, parent_ids)
+    pos = np.minimum(pos, len(sorted_ids) - 1)
+    found = sorted_ids[pos] == parent_ids
+    return np.where(found, order[pos], -1)
+
+
 def swc_to_tree(swc_arr):
     """Make tree structure from loaded data."""
     tr_data = np.transpose(swc_arr)
 
-    parents = [
-        np.where(tr_data[SWC_DCT["index"]] == i)[0][0] if len(np.where(tr_data[0] == i)[0]) > 0 else -1
-        for i in tr_data[SWC_DCT["parent"]]
-    ]
+    parents = _parent_rows(tr_data[SWC_DCT["index"]], tr_data[SWC_DCT["parent"]])
 
     return Tree(
         x=tr_data[SWC_DCT["x"]],
@@ -22,6 +22,7 @@ from itertools import chain
 import numpy as np
 from numpy.linalg import norm
 from scipy import stats
+from scipy.optimize import linear_sum_assignment
 from scipy.spatial.distance import cdist
 
 from morphomics.persistent_homology.ph_analysis import get_lengths
@@ -80,25 +81,31 @@ def find_apical_point_distance_smoothed(ph, threshold=0.1):
     return bin_centers[minimas[0]]
 
 
-def _symmetric(p):
-    """Returns the symmetric point of a PD point on the diagonal."""
-    return [(p[0] + p[1]) / 2.0, (p[0] + p[1]) / 2]
+def _symmetric_points(ph):
+    """Returns the symmetric points of the PD points on the diagonal."""
+    mid = np.asarray(ph, dtype=float).reshape(-1, 2).sum(axis=1) / 2.0
+    return np.column_stack([mid, mid])
 
 
 def matching_munkress_modified(p1, p2, use_diag=True):
-    """Find matching components and the corresponding distance between the two input diagrams."""
-    import munkres  # pylint: disable=import-outside-toplevel
+    """Find matching components and the corresponding distance between the two input diagrams.
 
+    The assignment is solved exactly with scipy's linear_sum_assignment.
+    """
+    p1, p2 = np.asarray(p1, dtype=float).reshape(-1, 2), np.asarray(p2, dtype=float).reshape(-1, 2)
     if use_diag:
-        p1_enh = p1 + [_symmetric(i) for i in p2]
-        p2_enh = p2 + [_symmetric(i) for i in p1]
+        p1_enh = np.concatenate([p1, _symmetric_points(p2)])
+        p2_enh = np.concatenate([p2, _symmetric_points(p1)])
     else:
         p1_enh = p1
         p2_enh = p2
 
     D = cdist(p1_enh, p2_enh)
-    m = munkres.Munkres()
-    indices = m.compute(np.copy(D))
-    ssum = np.sum([D[i][j] for (i, j) in indices])  # pylint: disable=unsubscriptable-object
+    if D.size == 0:
+        return [], 0.0
+
+    rows, cols = linear_sum_assignment(D)
+    ssum = D[rows, cols].sum()
+    indices = list(zip(rows.tolist(), cols.tolist()))
 
     return indices, ssum
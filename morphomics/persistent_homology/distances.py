@@ -1,24 +1,173 @@
+import hashlib
+import os
+from functools import partial
+
 import numpy as np
 from numpy.linalg import norm
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
 from scipy.spatial.distance import cdist, pdist, squareform
 from morphomics import utils
-from itertools import chain
 
 
-def get_barcode_dist_matrix(barcodes, metric):
+def get_barcode_dist_matrix(barcodes, metric, form="condensed", n_jobs=1, block_size=10000, checkpoint_dir=None, **kwargs):
     ''' Compute the distance matrix of the barcodes with respect to a norm (e.g. wasserstein distance).
 
+    The pairs (i, j) with i < j are split in blocks of consecutive rows, each block being a contiguous
+    slice of the condensed matrix. The blocks are computed in parallel and, if checkpoint_dir is given,
+    each block is saved there once computed and loaded instead of being computed again.
+
     Parameters
     ----------
     barcodes (list of np.array): the list of barcodes.
     metric (str): a key in dictionnary utils.barcode_dist.
+    form (str): "condensed" for the upper triangle as returned by pdist, "square" for the symmetric matrix,
+                "upper" for the square matrix with only its upper triangle filled.
+    n_jobs (int): the number of worker processes, -1 for all the cpus.
+    block_size (int): the approximate number of pairs per block.
+    checkpoint_dir (str): the folder where the computed blocks are saved, named after a hash of the metric,
+                          the kwargs and the barcodes so that the blocks of other barcodes are never reused.
+    kwargs: passed to the distance, e.g. order for "wd" and "sd".
 
     Returns
     -------
     dist_matrix (np.array): the paired distances of the barcodes based on the metric
     '''
+    dist_func = barcode_distances[utils.barcode_dist.get(metric, metric)]
+    barcodes = [_as_diagram(ph) for ph in barcodes]
+    n = len(barcodes)
+
+    row_blocks = _row_blocks(n, block_size)
+    offsets = _condensed_offsets(n, np.array([beg for beg, _ in row_blocks] + [n]))
+    paired_dist = np.zeros(n * (n - 1) // 2)
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        key = _checkpoint_key(barcodes, metric, kwargs)
+    _block_path = lambda beg, end: os.path.join(checkpoint_dir, "%s_%s_rows_%d_%d.npy" % (metric, key, beg, end))
+
+    todo = []
+    for block_idx, (beg, end) in enumerate(row_blocks):
+        if checkpoint_dir is not None and os.path.exists(_block_path(beg, end)):
+            paired_dist[offsets[block_idx]:offsets[block_idx + 1]] = np.load(_block_path(beg, end))
+        else:
+            todo.append(block_idx)
+
+    block_distances = utils.parallel_map(partial(_rows_distances, dist_func=dist_func, **kwargs),
+                                         [row_blocks[block_idx] for block_idx in todo],
+                                         n_jobs=n_jobs, initializer=_share_barcodes, initargs=(barcodes,))
+    for block_idx, distances in zip(todo, block_distances):
+        paired_dist[offsets[block_idx]:offsets[block_idx + 1]] = distances
+        if checkpoint_dir is not None:
+            np.save(_block_path(*row_blocks[block_idx]), distances)
+    _share_barcodes(None)
+
+    if form == "condensed":
+        return paired_dist
+    dist_matrix = np.zeros((n, n))
+    dist_matrix[np.triu_indices(n, 1)] = paired_dist
+    if form == "square":
+        dist_matrix = dist_matrix + dist_matrix.T
+    return dist_matrix
+
+
+def _condensed_offsets(n, rows):
+    """Returns the position in the condensed matrix of the first pair (i, i + 1) of each row i."""
+    rows = np.asarray(rows, dtype=np.int64)
+    return rows * n - rows * (rows + 1) // 2
+
+
+def _row_blocks(n, block_size):
+    """Returns the consecutive row ranges [beg, end) holding about block_size pairs (i, j > i) each."""
+    offsets = _condensed_offsets(n, np.arange(n))
+    targets = np.arange(block_size, n * (n - 1) // 2, block_size)
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(offsets, targets), [n]]))
+    return [(beg, end) for beg, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _checkpoint_key(barcodes, metric, kwargs):
+    """Returns a hash of the metric, the kwargs and the barcodes identifying the checkpointed blocks."""
+    key = hashlib.sha1(repr((metric, sorted(kwargs.items()), len(barcodes))).encode())
+    for ph in barcodes:
+        key.update(np.int64(len(ph)).tobytes())
+        key.update(np.ascontiguousarray(ph).tobytes())
+    return key.hexdigest()[:16]
+
+
+# The barcodes of the matrix being computed, sent once per worker by _share_barcodes
+_barcodes = None
+
+
+def _share_barcodes(barcodes):
+    global _barcodes
+    _barcodes = barcodes
 
-    return
+
+def _rows_distances(rows, dist_func, **kwargs):
+    """Returns the distances of the pairs (i, j > i) of the rows [beg, end) in the condensed order."""
+    barcodes = _barcodes
+    beg, end = rows
+    return np.array([dist_func(barcodes[i], barcodes[j], **kwargs)
+                     for i in range(beg, end) for j in range(i + 1, len(barcodes))], dtype=float)
+
+
+def _as_diagram(ph):
+    return np.asarray(ph, dtype=float).reshape(-1, 2)
+
+
+def _matching_costs(ph1, ph2):
+    """Returns the costs of matching the bars of ph1 and ph2, or of sending them to the diagonal.
+
+    The rows are the bars of ph1 followed by one diagonal point per bar of ph2, and the columns
+    the bars of ph2 followed by one diagonal point per bar of ph1. Two bars are compared with the
+    L-infinity distance and a bar is at |death - birth| / 2 of the diagonal, any diagonal point
+    being its projection. The diagonal points match together at no cost.
+    """
+    ph1, ph2 = _as_diagram(ph1), _as_diagram(ph2)
+    n1, n2 = len(ph1), len(ph2)
+    costs = np.zeros((n1 + n2, n2 + n1))
+    if n1 > 0 and n2 > 0:
+        costs[:n1, :n2] = cdist(ph1, ph2, metric="chebyshev")
+    costs[:n1, n2:] = (np.abs(ph1[:, 1] - ph1[:, 0]) / 2)[:, None]
+    costs[n1:, :n2] = (np.abs(ph2[:, 1] - ph2[:, 0]) / 2)[None, :]
+    return costs
+
+
+def wasserstein_distance(ph1, ph2, order=1):
+    """Calculate the Wasserstein distance of order `order` between two ph, with the L-infinity ground distance."""
+    costs = _matching_costs(ph1, ph2)
+    if costs.size == 0:
+        return 0.
+    costs = costs ** order
+    rows, cols = linear_sum_assignment(costs)
+    return costs[rows, cols].sum() ** (1. / order)
+
+
+def bottleneck_distance(ph1, ph2):
+    """Calculate the bottleneck distance between two ph.
+
+    It is the smallest cost such that the bars can be perfectly matched using only the
+    matchings cheaper than it, found by a binary search on the sorted costs.
+    """
+    costs = _matching_costs(ph1, ph2)
+    if costs.size == 0:
+        return 0.
+    # All the bars can go to the diagonal and none can do better than its cheapest matching
+    n1 = len(_as_diagram(ph1))
+    upper = max(costs[:n1, -1].max(initial=0.), costs[-1, :len(costs) - n1].max(initial=0.))
+    lower = max(costs.min(axis=1).max(), costs.min(axis=0).max())
+    candidates = np.unique(costs[(costs >= lower) & (costs <= upper)])
+
+    lo, hi = 0, len(candidates) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        matching = maximum_bipartite_matching(csr_matrix(costs <= candidates[mid]), perm_type="column")
+        if np.all(matching >= 0):
+            hi = mid
+        else:
+            lo = mid + 1
+    return candidates[lo]
 
 def get_vect_dist_matrix(vectors, metric = "l2"):
     ''' Compute the distance matrix of the vectors with respect to a norm (e.g. l2).
@@ -41,22 +190,26 @@ def get_dist_mat(paired_dist):
     dist_matrix = squareform(paired_dist)   # Convert to a square form matrix
     return dist_matrix
 
+def _stepped_counts(ph, bins):
+    """Returns the number of bars of ph with min(bar) <= bins[i + 1] and max(bar) > bins[i] for each interval i."""
+    ph = _as_diagram(ph)
+    first = np.maximum(np.searchsorted(bins, ph.min(axis=1), side="left") - 1, 0)
+    last = np.maximum(np.searchsorted(bins, ph.max(axis=1), side="left"), first)
+    counts = np.bincount(first, minlength=len(bins)) - np.bincount(last, minlength=len(bins))
+    return np.cumsum(counts)[:len(bins) - 1].astype(float)
+
+
 def distance_stepped(ph1, ph2, order=1):
     """Calculate step distance difference between two ph."""
-    bins1 = np.unique(list(chain(*ph1)))
-    bins2 = np.unique(list(chain(*ph2)))
-    bins = np.unique(np.append(bins1, bins2))
-    results1 = np.zeros(len(bins) - 1)
-    results2 = np.zeros(len(bins) - 1)
-
-    for bar in ph1:
-        for it, _ in enumerate(bins[:-1]):
-            if min(bar) <= bins[it + 1] and max(bar) > bins[it]:
-                results1[it] = results1[it] + 1
-
-    for bar in ph2:
-        for it, _ in enumerate(bins[:-1]):
-            if min(bar) <= bins[it + 1] and max(bar) > bins[it]:
-                results2[it] = results2[it] + 1
-
-    return norm(np.abs(np.subtract(results1, results2)) * (bins[1:] + bins[:-1]) / 2, order)
\ No newline at end of file
+    bins = np.unique(np.concatenate([_as_diagram(ph1).ravel(), _as_diagram(ph2).ravel()]))
+    results1 = _stepped_counts(ph1, bins)
+    results2 = _stepped_counts(ph2, bins)
+
+    return norm(np.abs(np.subtract(results1, results2)) * (bins[1:] + bins[:-1]) / 2, order)
+
+
+barcode_distances = {
+    "bottleneck_distance": bottleneck_distance,
+    "wasserstein_distance": wasserstein_distance,
+    "distance_stepped": distance_stepped,
+}
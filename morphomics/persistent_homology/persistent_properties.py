@@ -91,7 +91,7 @@ class PersistentAngles(PersistentProperty):
 
     def __init__(self, tree):
         section_begs, _ = tree.sections
-        section_parents, section_children = tree.parents_children
+        section_parents, section_children = tree.parents_children()
 
         self._angles = self._get_angles(tree, section_begs, section_parents, section_children)
 
@@ -15,9 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from functools import partial
+
 import numpy as np
 import scipy.spatial as sp
 
+from morphomics.cells.neuron.neuron import Neuron
+from morphomics.cells.tree.tree import Tree
+from morphomics.utils import concatenated_ranges, get_nb_workers, parallel_map, restore_nan
+
 #from morphomics.tmd.analysis import sort_ph
 from morphomics.persistent_homology.persistent_properties import NoProperty
 from morphomics.persistent_homology.persistent_properties import PersistentAngles
@@ -29,6 +35,11 @@ def tree_to_property_barcode(tree, filtration_function, property_class=NoPropert
 
     Each bar in the barcode is optionally linked with a property determined by property_class.
 
+    The section nodes are processed level by level from the leaves to the root: at each
+    branch point, the child component with the largest filtration value survives and the
+    others die. The bars are then ordered as they would be found by successive sweeps
+    over the alive components, from the lowest to the highest node id.
+
     Args:
         filtration_function (Callable[tree] -> np.ndarray):
             The filtration function to apply on the tree
@@ -49,50 +60,93 @@ def tree_to_property_barcode(tree, filtration_function, property_class=NoPropert
             corresponds to the set of endpoints (i.e. the end point of each section)
             that belong to the corresponding persistent component - or bar.
     """
-    point_values = filtration_function(tree)
+    point_values = np.array(filtration_function(tree), dtype=float)
 
     beg, _ = tree.sections
-    parents, children = tree.parents_children()
+    children_ptr, children_idx, component_ids, levels = tree.topology.section_graph
 
     prop = property_class(tree)
 
-    active = tree.get_node_children_number() == 0
-    alives = np.where(active)[0]
-    point_ids_track = {al: [al] for al in alives}
-    bars_to_points = []
+    n = tree.size()
+    # Value of the component that survives at each node
+    values = point_values.copy()
+    # Child through which the surviving component arrives, -1 for the leaves
+    winner = np.full(n, -1, dtype=np.int64)
+    # Sweep and node id of the sweep at which a node becomes alive,
+    # the leaves are alive before the first sweep
+    sweep = np.zeros(n, dtype=np.int64)
+    trigger = np.full(n, -1, dtype=np.int64)
+
+    bar_nodes, bar_deaths, bar_components, bar_sweeps, bar_triggers = [], [], [], [], []
+    for level in levels[::-1]:
+        parents = level[children_ptr[level + 1] > children_ptr[level]]
+        if len(parents) == 0:
+            continue
+        seg_starts, seg_stops = children_ptr[parents], children_ptr[parents + 1]
+        counts = seg_stops - seg_starts
+        c = children_idx[concatenated_ranges(seg_starts, seg_stops)]
+        seg = np.repeat(np.arange(len(parents)), counts)
+        offsets = np.cumsum(counts) - counts
+        pos = np.arange(len(c))
+
+        # First child with the largest absolute value survives
+        abs_values = np.abs(values[c])
+        seg_max = np.maximum.reduceat(abs_values, offsets)
+        mx = np.minimum.reduceat(np.where(abs_values == seg_max[seg], pos, len(c)), offsets)
+
+        # A parent merges during the last sweep that activated one of its children, if a
+        # child alive before that sweep is visited after all of them, otherwise in the next sweep.
+        last = np.maximum.reduceat(sweep[c], offsets)
+        last_trigger = np.maximum.reduceat(np.where(sweep[c] == last[seg], trigger[c], -1), offsets)
+        late = (sweep[c] < last[seg]) & (c > last_trigger[seg])
+        late_child = np.minimum.reduceat(np.where(late, c, n), offsets)
+        merged_late = late_child < n
+        sweep[parents] = np.where(merged_late, last, last + 1)
+        trigger[parents] = np.where(merged_late, late_child, np.minimum.reduceat(c, offsets))
+
+        losers = np.ones(len(c), dtype=bool)
+        losers[mx] = False
+        bar_nodes.append(c[losers])
+        bar_deaths.append(values[parents][seg[losers]])
+        bar_components.append(component_ids[parents][seg[losers]])
+        bar_sweeps.append(sweep[parents][seg[losers]])
+        bar_triggers.append(trigger[parents][seg[losers]])
+
+        winner[parents] = c[mx]
+        values[parents] = values[c[mx]]
 
     ph = []
-    while len(alives) > 1:
-        for alive in alives:
-            p = parents[alive]
-            c = children[p]
-
-            if np.all(active[c]):
-                active[p] = True
-                active[c] = False
-
-                mx = np.argmax(abs(point_values[c]))
-                mx_id = c[mx]
-
-                c = np.delete(c, mx)
-
-                for ci in c:
-                    component_id = np.where(beg == p)[0][0]
-                    ph.append([point_values[ci], point_values[p]] + prop.get(component_id))
-                    bars_to_points.append(point_ids_track[ci])
-
-                point_values[p] = point_values[mx_id]
-                point_ids_track[p] = point_ids_track[mx_id] + [p]
-        alives = np.where(active)[0]
-
+    bars_to_points = []
+    if len(bar_nodes) > 0:
+        bar_nodes = np.concatenate(bar_nodes)
+        bar_deaths = np.concatenate(bar_deaths)
+        bar_components = np.concatenate(bar_components)
+        # Stable sort keeps the increasing order of the children of a same parent
+        bar_order = np.lexsort((np.concatenate(bar_triggers), np.concatenate(bar_sweeps)))
+        for i in bar_order:
+            ph.append([values[bar_nodes[i]], bar_deaths[i]] + prop.get(bar_components[i]))
+            bars_to_points.append(_component_points(bar_nodes[i], winner))
+
+    # The last alive component, a root with a single section child is never reached
+    last_alive = 0
+    if children_ptr[1] - children_ptr[0] == 1:
+        last_alive = children_idx[children_ptr[0]]
     ph.append(
-        [point_values[alives[0]], 0] + prop.infinite_component(beg[0])
+        [values[last_alive], 0] + prop.infinite_component(beg[0])
     )  # Add the last alive component
-    bars_to_points.append(point_ids_track[alives[0]])
+    bars_to_points.append(_component_points(last_alive, winner))
     ph = np.array(ph)
     return ph, bars_to_points
 
 
+def _component_points(node, winner):
+    """Returns the section nodes of the component that survives at node, from its leaf to node."""
+    points = [node]
+    while winner[points[-1]] != -1:
+        points.append(winner[points[-1]])
+    return points[::-1]
+
+
 def _filtration_function(feature, **kwargs):
     """Returns filtration function lambda that will be applied point-wise on the tree."""
     return lambda tree: getattr(tree, "get_nodes_" + feature)(**kwargs)
@@ -145,7 +199,64 @@ def get_ph_neuron(neuron, feature="radial_distance", neurite_type="all", **kwarg
     return ph_neuron
 
 
+def _tree_to_arrays(tree):
+    """Returns the node arrays of a tree, they are cheaper to send to a worker than the Tree."""
+    return (tree.x, tree.y, tree.z, tree.d, tree.t, tree.p)
+
+
+def _cell_to_arrays(cell, neurite_type="all"):
+    """Returns the list of node arrays of the trees of a cell, None if the cell is missing."""
+    if isinstance(cell, Tree):
+        return [_tree_to_arrays(cell)]
+    if isinstance(cell, Neuron):
+        type_list = ["neurites"] if neurite_type == "all" else [neurite_type]
+        return [_tree_to_arrays(tree) for t_type in type_list for tree in getattr(cell, t_type)]
+    return None
 
 
+def _ph_from_arrays(trees_arrays, feature="radial_distance", **kwargs):
+    """Computes the ph of the trees of one cell given as node arrays.
+
+    Returns the stacked ph and None, or np.nan and the error message if it failed.
+    """
+    if trees_arrays is None:
+        return np.nan, None
+    try:
+        ph_cell = [get_persistence_diagram(Tree(*arrays), feature=feature, **kwargs) for arrays in trees_arrays]
+        return np.vstack(ph_cell), None
+    except Exception as e:  # pylint: disable=broad-except
+        return np.nan, "%s: %s" % (type(e).__name__, e)
+
 
+def get_ph_batch(cells, feature="radial_distance", neurite_type="all", n_jobs=1, chunksize=None, **kwargs):
+    """Method to extract the ph of many trees or neurons with a pool of worker processes.
 
+    The trees are sent to the workers as node arrays and the cells are scheduled by chunks.
+    A cell that fails does not stop the others, its ph is np.nan and the error is returned.
+
+    Args:
+        cells (list): Tree or Neuron instances, other items (e.g. np.nan) give np.nan.
+        feature (str): the filtration function, radial_distance or path_distance.
+        neurite_type (str): the type of trees of the neurons used, "all" uses the neurites.
+        n_jobs (int): number of worker processes, -1 uses all the cpus.
+        chunksize (int): number of cells sent at once to a worker, if None or 0 it is set from the number of cells.
+
+    Returns:
+        phs (list): the ph of each cell, in the order of cells.
+        errors (dict): the error message of each failed cell, by position in cells.
+    """
+    nb_workers = get_nb_workers(n_jobs)
+    if not chunksize:
+        chunksize = max(1, len(cells) // (16 * nb_workers))
+
+    trees_arrays = (_cell_to_arrays(cell, neurite_type=neurite_type) for cell in cells)
+    phs, errors = [], {}
+    for i, (ph, error) in enumerate(parallel_map(partial(_ph_from_arrays, feature=feature, **kwargs),
+                                                 trees_arrays,
+                                                 n_jobs=nb_workers,
+                                                 chunksize=chunksize)):
+        # The np.nan of a failed cell comes back from the workers as a new NaN float
+        phs.append(np.nan if error is not None else restore_nan(ph))
+        if error is not None:
+            errors[i] = error
+    return phs, errors
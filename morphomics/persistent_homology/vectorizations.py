@@ -15,17 +15,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from functools import partial
+from itertools import chain
+
 import numpy as np
 from scipy import stats
-from itertools import chain
 
 from morphomics.persistent_homology.ph_analysis import get_limits, get_lengths, get_total_length
+from morphomics.utils import get_nb_workers, norm_methods, parallel_map
 
 
 ### 2D vectorizations
 
 def persistence_image(
-    ph, method="kde", std_isotropic=0.1, xlim=None, ylim=None, bw_method=None, weights=None, resolution=100
+    ph, method="kde", std_isotropic=0.1, xlim=None, ylim=None, bw_method=None, weights=None, resolution=100,
+    chunk_size=4096,
 ):
     """Create array of the persistence image.
 
@@ -38,59 +42,121 @@ def persistence_image(
         bw_method: The method used to calculate the estimator bandwidth for the gaussian_kde.
         weights: weights of the diagram points
         resolution: number of pixels in each dimension
+        chunk_size: number of bars processed at once by the isotropic method.
 
     If xlim, ylim are provided the data will be scaled accordingly.
     """
     if xlim is None or ylim is None:
         xlim, ylim = get_limits(ph)
-    res = complex(0, resolution)
-    X, Y = np.mgrid[xlim[0] : xlim[1] : res, ylim[0] : ylim[1] : res]
-    positions = np.vstack([X.ravel(), Y.ravel()])
-    values = np.transpose(ph)
+    xs, ys = _image_grid(xlim, ylim, resolution)
 
+    return _image_on_grid(ph, xs, ys, method=method, std_isotropic=std_isotropic, bw_method=bw_method,
+                          weights=weights, chunk_size=chunk_size)
+
+def _image_on_grid(ph, xs, ys, method="kde", std_isotropic=0.1, bw_method=None, weights=None, chunk_size=4096):
+    """Returns the persistence image of ph on the pixel grid xs × ys, see persistence_image."""
     if method == "kde":
+        X, Y = np.meshgrid(xs, ys, indexing="ij")
+        positions = np.vstack([X.ravel(), Y.ravel()])
+        values = np.transpose(ph)
         kernel = stats.gaussian_kde(values, bw_method=bw_method, weights=weights)
         Z = np.reshape(kernel(positions).T, X.shape)
     elif method == "isotropic":
-        Z = _pi_isotropic(ph, positions.T, std_isotropic)
-        Z = np.reshape(Z, X.shape)
+        Z = _pi_separable(ph, xs, ys, std_isotropic, weights=weights, chunk_size=chunk_size)
 
     return Z
 
-def _pi_isotropic(ph, eval_points, std):
+def _image_grid(xlim, ylim, resolution):
+    """Returns the pixel centers on each axis, the same as np.mgrid with a complex step."""
+    res = complex(0, resolution)
+    return np.mgrid[xlim[0] : xlim[1] : res], np.mgrid[ylim[0] : ylim[1] : res]
+
+def _fill_persistence_images(ph_list, out, xlim=None, ylim=None, norm_method="sum", **kwargs):
+    """Writes the flattened persistence images of ph_list in the rows of out and normalizes them in place."""
+    resolution = int(np.sqrt(out.shape[1]))
+    shared_grid = None if xlim is None or ylim is None else _image_grid(xlim, ylim, resolution)
+    norm_m = norm_methods[norm_method]
+    for row, ph in zip(out, ph_list):
+        xs, ys = shared_grid if shared_grid is not None else _image_grid(*get_limits(ph), resolution)
+        row[:] = _image_on_grid(ph, xs, ys, **kwargs).ravel()
+        row /= norm_m(row)
+    return out
+
+def _persistence_images_chunk(ph_list, resolution=100, **kwargs):
+    """Returns the images of a chunk of barcodes, run by the worker processes."""
+    out = np.empty((len(ph_list), resolution**2), dtype=np.float32)
+    return _fill_persistence_images(ph_list, out, **kwargs)
+
+def persistence_images(
+    ph_list, method="kde", std_isotropic=0.1, xlim=None, ylim=None, bw_method=None, weights=None, resolution=100,
+    norm_method="sum", n_jobs=1, chunksize=None,
+):
+    """Create the flattened and normalized persistence images of a list of barcodes.
+
+    The images are written in a preallocated (len(ph_list), resolution**2) float32 array.
+    If xlim and ylim are provided the pixel grid is computed once and shared by all the barcodes,
+    otherwise each image uses the limits of its barcode.
+    The barcodes are processed by n_jobs worker processes (-1 uses all the cpus), sent by chunks
+    of chunksize barcodes, see persistence_image for the other arguments.
+
+    Returns:
+        images (np.ndarray): (len(ph_list), resolution**2) array, an image per row, in the order of ph_list.
     """
-    Compute KDE for a dataset of 2D points using an isotropic Gaussian kernel.
+    ph_list = list(ph_list)
+    kwargs = {"method": method, "std_isotropic": std_isotropic, "xlim": xlim, "ylim": ylim,
+              "bw_method": bw_method, "weights": weights, "norm_method": norm_method}
+
+    images = np.empty((len(ph_list), resolution**2), dtype=np.float32)
+    nb_workers = get_nb_workers(n_jobs)
+    if nb_workers == 1:
+        return _fill_persistence_images(ph_list, images, **kwargs)
+
+    if not chunksize:
+        chunksize = max(1, len(ph_list) // (4 * nb_workers))
+    chunks = [ph_list[start : start + chunksize] for start in range(0, len(ph_list), chunksize)]
+    start = 0
+    for chunk_images in parallel_map(partial(_persistence_images_chunk, resolution=resolution, **kwargs),
+                                     chunks, n_jobs=n_jobs):
+        images[start : start + len(chunk_images)] = chunk_images
+        start += len(chunk_images)
+    return images
+
+def _pi_separable(ph, xs, ys, std, weights=None, chunk_size=4096):
+    """
+    Compute the sum of isotropic Gaussian kernels centered on the bars on the grid xs × ys.
+
+    The 2D kernel is the product of two 1D kernels, so the image is the matrix product
+    Kx · W · Kyᵀ of the (len(xs), N) and (len(ys), N) kernel matrices with the diagonal of the
+    bar weights. The bars are processed by chunks of chunk_size to bound the memory.
 
     Parameters:
     - ph: np.ndarray, shape (N, 2)
         Array of 2D points from the dataset.
-    - eval_points: np.ndarray, shape (M, 2)
-        Array of 2D points where the KDE should be evaluated.
+    - xs, ys: np.ndarray
+        The coordinates of the grid on each axis.
     - std: float
         Standard deviation of the isotropic Gaussian kernel.
+    - weights: np.ndarray, shape (N,)
+        The weight of each bar, 1 by default.
 
     Returns:
-    - kde_values: np.ndarray, shape (M,)
-        The KDE values at each of the evaluation points.
+    - kde_values: np.ndarray, shape (len(xs), len(ys))
+        The KDE values at each of the grid points.
     """
-    # Ensure input is numpy arrays
-    data_points = np.asarray(ph)
-    eval_points = np.asarray(eval_points)
+    data_points = np.asarray(ph, dtype=float).reshape(-1, 2)
+    weights = np.ones(len(data_points)) if weights is None else np.asarray(weights, dtype=float)
 
     # Gaussian kernel normalization constant in 2D
     normalization = 1 / (2 * np.pi * std**2)
 
-    # Compute pairwise squared distances using broadcasting
-    diff = eval_points[:, np.newaxis, :] - data_points[np.newaxis, :, :]  # Shape: (M, N, 2)
-    squared_distances = np.sum(diff**2, axis=2)  # Shape: (M, N)
-
-    # Apply Gaussian kernel
-    weights = np.exp(-squared_distances / (2 * std**2))  # Shape: (M, N)
+    kde_values = np.zeros((len(xs), len(ys)))
+    for start in range(0, len(data_points), chunk_size):
+        bars = data_points[start : start + chunk_size]
+        kernel_x = np.exp(-np.subtract.outer(xs, bars[:, 0]) ** 2 / (2 * std**2))
+        kernel_y = np.exp(-np.subtract.outer(ys, bars[:, 1]) ** 2 / (2 * std**2))
+        kde_values += (kernel_x * weights[start : start + chunk_size]) @ kernel_y.T
 
-    # Sum over the data points (axis=1) and normalize
-    kde_values = normalization * np.sum(weights, axis=1)  # Shape: (M,)
-
-    return kde_values
+    return normalization * kde_values
 
 
 ### 1D curve vectorizations
@@ -102,15 +168,35 @@ def _index_bar(bar, t):
     else:
         return 0
 
+def _bars_alive(ph, t_list, values=None):
+    """Returns for each t of t_list the number of bars with min(bar) <= t <= max(bar),
+    or the sum of the values of these bars.
+
+    The bar starts and ends are sorted once, the bars alive at t are the bars started at t
+    minus the bars ended before t, both found with searchsorted. The values are accumulated
+    in extended precision so that the difference of the cumulative sums does not lose digits.
+    """
+    ph = np.asarray(ph, dtype=float)
+    starts, ends = np.min(ph[:, :2], axis=1), np.max(ph[:, :2], axis=1)
+    t_list = np.asarray(t_list, dtype=float)
+    if values is None:
+        return np.searchsorted(np.sort(starts), t_list, side="right") - np.searchsorted(np.sort(ends), t_list, side="left")
+
+    start_order, end_order = np.argsort(starts), np.argsort(ends)
+    values = np.asarray(values, dtype=np.longdouble)
+    started = np.concatenate([[0], np.cumsum(values[start_order])])
+    ended = np.concatenate([[0], np.cumsum(values[end_order])])
+    started = started[np.searchsorted(starts[start_order], t_list, side="right")]
+    ended = ended[np.searchsorted(ends[end_order], t_list, side="left")]
+    return (started - ended).astype(float)
+
 def betti_curve(ph, t_list=None, resolution=1000):
     """Computes the betti curve of a persistence diagram.
     Corresponding to the number of bars at each distance t.
     """
     if t_list is None:
         t_list = np.linspace(np.min(ph), np.max(ph), resolution)
-    ph = np.array(ph)
-    ph[:, [0, 1]] = np.sort(ph[:, [0, 1]], axis=1)
-    betti_c = np.array( [np.count_nonzero((ph[:, 0] <= x) & (ph[:, 1] >= x)) for x in t_list] )
+    betti_c = _bars_alive(ph, t_list)
     return betti_c, t_list
 
 def lifespan_curve(ph, t_list = None, resolution = 1000):
@@ -119,13 +205,7 @@ def lifespan_curve(ph, t_list = None, resolution = 1000):
     if t_list is None:
         t_list = np.linspace(np.min(ph), np.max(ph), resolution)
     bars_length = get_lengths(ph, type="abs")
-    # bar_differences = bar_differences.ravel().astype(float)
-    lifespan_c = [np.sum([
-                        bar_len if _index_bar(bar, t) else 0.
-                        for bar, bar_len in zip(ph, bars_length)
-                        ])
-                    for t in t_list
-                ]
+    lifespan_c = _bars_alive(ph, t_list, bars_length)
     return lifespan_c, t_list
 
 def _bar_entropy(bar, lifetime):
@@ -137,33 +217,59 @@ def life_entropy_curve(ph, t_list=None, resolution=1000):
     """The life entropy curve, computes life entropy at different t values."""
     lifetime = get_total_length(ph)
     # Compute the entropy of each bar
-    entropy = [_bar_entropy(bar, lifetime) for bar in ph]
+    ph = np.asarray(ph, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = _bar_entropy(ph.T, lifetime)
     if t_list is None:
         t_list = np.linspace(np.min(ph), np.max(ph), resolution)
-    entropy_c = [
-        -np.sum([_index_bar(ph_bar, t) * e for (e, ph_bar) in zip(entropy, ph)])
-        for t in t_list
-    ]
+    entropy_c = -_bars_alive(ph, t_list, entropy)
+    # A bar of length 0 has an undefined entropy that spreads to the whole curve
+    if np.any(np.isnan(entropy)):
+        entropy_c[:] = np.nan
     return entropy_c, t_list
 
 # 1D ordered vectorization
 
 def stable_ranks(bar_lengths, prob, maxL, disc_steps):
     """Compute the stable ranks of a barcode."""
-    if len(bar_lengths) == 0:
-        return np.zeros(disc_steps)
-    
-    if prob=="long":
-        prob_bars = bar_lengths / bar_lengths.sum()
-    elif prob=="short":
-        prob_bars = (bar_lengths.max() - bar_lengths) / (bar_lengths.max() - bar_lengths).sum()
-        
-    x_values = np.linspace(0, maxL, num=disc_steps)
+    return stable_ranks_batch([bar_lengths], prob, maxL, disc_steps)[0]
+
+def stable_ranks_batch(bar_lengths_list, prob, maxL, disc_steps):
+    """Compute the stable ranks of many barcodes, a (n_cells, disc_steps) array.
 
-    if prob=="long" or prob=="short":
-        sr = np.array( [bar_lengths.shape[0]*prob_bars[bar_lengths >= x].sum() for x in x_values] )
+    The bar lengths of all the cells are kept in one flat array with the cell of each bar.
+    A bar of length L counts for the thresholds x <= L, i.e. the first searchsorted(x, L, "right")
+    thresholds, so the ranks are reversed cumulative sums of the bars ending at each threshold.
+    With prob "long" or "short" the bars are weighted by their probability of being picked,
+    the longest or the shortest bars being the most likely, and the sums are scaled by the number of bars.
+    """
+    bar_lengths_list = [np.asarray(bar_lengths, dtype=float) for bar_lengths in bar_lengths_list]
+    n_cells = len(bar_lengths_list)
+    nb_bars = np.array([len(bar_lengths) for bar_lengths in bar_lengths_list], dtype=np.int64)
+    lengths = np.concatenate(bar_lengths_list) if n_cells > 0 else np.zeros(0)
+    cell_ids = np.repeat(np.arange(n_cells), nb_bars)
+
+    x_values = np.linspace(0, maxL, num=disc_steps)
+    nb_thresholds = np.searchsorted(x_values, lengths, side="right")
+
+    if prob == "long" or prob == "short":
+        offsets = np.concatenate([[0], np.cumsum(nb_bars)])
+        if prob == "long":
+            weights = lengths
+        else:
+            max_lengths = np.maximum.reduceat(lengths, offsets[:-1][nb_bars > 0]) if len(lengths) else []
+            weights = np.repeat(max_lengths, nb_bars[nb_bars > 0]) - lengths
+        totals = np.add.reduceat(weights, offsets[:-1][nb_bars > 0]) if len(lengths) else []
+        with np.errstate(divide="ignore", invalid="ignore"):
+            prob_bars = weights / np.repeat(totals, nb_bars[nb_bars > 0])
+        ends = np.zeros((n_cells, disc_steps + 1), dtype=np.longdouble)
+        np.add.at(ends, (cell_ids, nb_thresholds), prob_bars)
+        sr = np.cumsum(ends[:, ::-1], axis=1)[:, ::-1][:, 1:].astype(float)
+        sr = nb_bars[:, None] * sr
     else:
-        sr = np.array( [np.count_nonzero(bar_lengths >= x) for x in x_values] )
+        ends = np.bincount(cell_ids * (disc_steps + 1) + nb_thresholds,
+                           minlength=n_cells * (disc_steps + 1)).reshape(n_cells, disc_steps + 1)
+        sr = np.cumsum(ends[:, ::-1], axis=1)[:, ::-1][:, 1:]
 
     return sr
 
@@ -181,44 +287,75 @@ def histogram_stepped(ph):
 
 # 1D histogram vectorizations
 
-def _mask_bars(ph, bins):
-    ph = np.sort(ph)
-    starts = ph[:,0]
-    ends = ph[:,1]
-    masks = []
-    for bin in bins:
-        mask_a = starts < bin[1]
-        mask_b = bin[0] < ends
-        mask = np.logical_and(mask_a, mask_b)
-        masks.append(mask)
-    return masks
+def _bins_overlaps(ph, bins):
+    """Returns for each bar the first bin it overlaps and the bin after the last one.
+
+    A bar overlaps a bin if min(bar) < bin[1] and bin[0] < max(bar). The bins must be sorted,
+    as the ones of _subintervals, so that the overlapped bins are consecutive.
+    """
+    ph = np.asarray(ph, dtype=float)
+    bins = np.asarray(bins, dtype=float)
+    starts, ends = np.min(ph[:, :2], axis=1), np.max(ph[:, :2], axis=1)
+    first = np.searchsorted(bins[:, 1], starts, side="right")
+    last = np.searchsorted(bins[:, 0], ends, side="left")
+    return first, np.maximum(first, last)
+
+def _overlaps_hist(first, last, n_bins, values=None, cell_ids=None, n_cells=1):
+    """Returns the (n_cells, n_bins) sums of the values, or the counts, of the bars over the bins
+    they overlap, from a difference array: +value at the first bin and -value after the last one."""
+    cell_ids = np.zeros(len(first), dtype=np.int64) if cell_ids is None else np.asarray(cell_ids)
+    if values is None:
+        diff = np.zeros((n_cells, n_bins + 1), dtype=np.int64)
+        values = 1
+    else:
+        # The cumulative sums are done in extended precision so that the differences do not lose digits
+        diff = np.zeros((n_cells, n_bins + 1), dtype=np.longdouble)
+        values = np.asarray(values, dtype=np.longdouble)
+    np.add.at(diff, (cell_ids, first), values)
+    np.add.at(diff, (cell_ids, last), -values)
+    hist = np.cumsum(diff, axis=1)[:, :-1]
+    return hist if hist.dtype == np.int64 else hist.astype(float)
 
 def _subintervals(xlims, num_bins = 1000):
     # Generate the linspace array
     linspace_array = np.linspace(xlims[0], xlims[1], num_bins+1)
     # Create subintervals
-    subintervals = np.array([[linspace_array[i], linspace_array[i + 1]] for i in range(num_bins)])
+    subintervals = np.column_stack([linspace_array[:-1], linspace_array[1:]])
     return subintervals
 
 def betti_hist(ph, bins = None, num_bins = 1000):
     if bins is None:
         xlims = [np.min(ph), np.max(ph)]
         bins = _subintervals(xlims=xlims, num_bins=num_bins)
-    masks = _mask_bars(ph, bins)
-    betti_h = np.sum(masks, axis=-1)
+    first, last = _bins_overlaps(ph, bins)
+    betti_h = _overlaps_hist(first, last, len(bins))[0]
     return betti_h, bins
 
 def lifespan_hist(ph, bins = None, num_bins = 1000):
     if bins is None:
         xlims = [np.min(ph), np.max(ph)]
         bins = _subintervals(xlims=xlims, num_bins=num_bins)
-    masks = _mask_bars(ph, bins)
+    first, last = _bins_overlaps(ph, bins)
 
     bars_length = get_lengths(ph, type="abs")
-    lifespan_h = [np.sum([
-                        bar_len if m else 0.
-                        for m, bar_len in zip(mask, bars_length)
-                        ])
-                    for mask in masks
-                ]
-    return lifespan_h, bins
\ No newline at end of file
+    lifespan_h = _overlaps_hist(first, last, len(bins), values=bars_length)[0]
+    return lifespan_h, bins
+
+def _batch_overlaps(ph_list, bins):
+    """Returns the overlapped bins of the bars of all the barcodes and the barcode of each bar."""
+    overlaps = [_bins_overlaps(ph, bins) for ph in ph_list]
+    first = np.concatenate([f for f, _ in overlaps]) if overlaps else np.zeros(0, dtype=np.int64)
+    last = np.concatenate([l for _, l in overlaps]) if overlaps else np.zeros(0, dtype=np.int64)
+    cell_ids = np.repeat(np.arange(len(overlaps)), [len(f) for f, _ in overlaps])
+    return first, last, cell_ids
+
+def betti_hists(ph_list, bins):
+    """Returns the betti histograms of all the barcodes on the shared bins, a (n_cells, n_bins) array."""
+    first, last, cell_ids = _batch_overlaps(ph_list, bins)
+    return _overlaps_hist(first, last, len(bins), cell_ids=cell_ids, n_cells=len(ph_list))
+
+def lifespan_hists(ph_list, bins):
+    """Returns the lifespan histograms of all the barcodes on the shared bins, a (n_cells, n_bins) array."""
+    first, last, cell_ids = _batch_overlaps(ph_list, bins)
+    bars_length = np.concatenate([get_lengths(ph, type="abs") for ph in ph_list]) if len(ph_list) else []
+    return _overlaps_hist(first, last, len(bins), values=bars_length, cell_ids=cell_ids, n_cells=len(ph_list))
@@ -1,7 +1,9 @@
 import os
+import tempfile
 
 import morphomics
 from morphomics.io import io
+from morphomics.io import store
 
 from morphomics.cells.population.population import Population
 from morphomics.protocols.default_parameters import DefaultParams
@@ -75,7 +77,7 @@ class Pipeline(object):
 
         Parameters
         ----------
-        variable_filepath (str): Path to the file that contains the variable of interest.
+        variable_filepath (str): Path to the file that contains the variable of interest, a .pkl file or a .morpho store.
         variable_name (str): Name of the variable of interest in self.morphoframe.
         morphoframe (bool): Choose between self.morphoframe and self.metadata.
         
@@ -86,7 +88,11 @@ class Pipeline(object):
 
         if variable_filepath:
             print("Loading %s file..." %(variable_filepath))
-            _morphoframe = io.load_obj(variable_filepath.replace(".pkl", ""))
+            if store.is_morphostore(variable_filepath):
+                # Columnar store, the node arrays of the cells are memory-mapped
+                _morphoframe = store.load_morphoframe(variable_filepath)
+            else:
+                _morphoframe = io.load_obj(variable_filepath.replace(".pkl", ""))
         elif morphoframe:
             _morphoframe = self.morphoframe[variable_name]  
         else:
@@ -130,6 +136,24 @@ class Pipeline(object):
 
         return save_filepath
     
+    def _save_morphoframe(self, morphoframe, save_filepath, save_format = 'pkl'):
+        """
+        Saves a morphoframe either as a pickle or in the columnar store.
+
+        Parameters
+        ----------
+        morphoframe (DataFrame): The morphoframe to save.
+        save_filepath (str): The path of the file without extension.
+        save_format (str): 'pkl' pickles the whole morphoframe, 
+                            'morpho' saves the node arrays of the cells in a columnar store that is memory-mapped when loaded.
+        """
+        if save_format == 'morpho':
+            store.save_morphoframe(morphoframe, save_filepath)
+        elif save_format == 'pkl':
+            io.save_obj(morphoframe, save_filepath)
+        else:
+            raise ValueError("save_format must be either 'pkl' or 'morpho', not %s" % save_format)
+
     def _image_filtering(self, persistence_images, params, save_filepath):
 
         #if os.path.isfile(params["FilteredPixelIndex_filepath"]):
@@ -172,10 +196,12 @@ class Pipeline(object):
             extension (str): .swc file extension, "_corrected.swc" refers to .swc files that were corrected with NeurolandMLConverter.
             conditions (list, str): This must match the hierarchical structure of `data_location_filepath`.
             separated_by (str): Saving chunks of the morphoframe via this condition, this must be an element of `conditions`.
+            n_jobs (int): Number of worker processes reading the .swc files and building the Neurons, -1 uses all the cpus.
             morphoframe_name (str): This is how the variable in self.morphoframe will be called.
             save_data (bool): Trigger to save output of protocol.
             save_folderpath (str): Location where to save the variable.
             save_filename (str or 0): This will be used as the file name.
+            save_format (str): 'pkl' pickles the morphoframe, 'morpho' saves the cells in a columnar store (.morpho) that loads much faster.
         
         Returns
         -------
@@ -190,12 +216,14 @@ class Pipeline(object):
         extension = params["extension"]
         conditions = params["conditions"]
         separated_by = params["separated_by"]
+        n_jobs = params["n_jobs"]
 
         morphoframe_name = params["morphoframe_name"]
         
         save_data = params["save_data"]
         save_folderpath = params["save_folderpath"]
         save_filename = params["save_filename"]        
+        save_format = params["save_format"]
         # define output filename
         default_save_filename = "Cell"
 
@@ -228,6 +256,7 @@ class Pipeline(object):
                 # Set the columns of swc arrays and Neuron.
                 my_population = Population(info_frame = _sub_info_frame,
                                             conditions = conditions,
+                                            n_jobs = n_jobs,
                                             )
                 morphoframe[_v] = my_population.cells
                 
@@ -245,7 +274,7 @@ class Pipeline(object):
                                                             default_save_filename = _default_save_filename, 
                                                             save_data = save_data)
                     print("Saving sub dataset in %s"%(_save_filepath))
-                    io.save_obj(morphoframe[_v], _save_filepath)
+                    self._save_morphoframe(morphoframe[_v], _save_filepath, save_format)
                     print("The sub dataset is saved in %s" %(_save_filepath))
                     print(" ")
             _morphoframe = pd.concat([morphoframe[_v] for _v in cond_values], ignore_index=True)
@@ -254,6 +283,7 @@ class Pipeline(object):
             # Set the columns of swc arrays and Neuron.
             my_population = Population(info_frame = info_frame,
                                         conditions = conditions,
+                                        n_jobs = n_jobs,
                                         )
             _morphoframe = my_population.cells
 
@@ -273,7 +303,7 @@ class Pipeline(object):
         # save the file 
         if save_data:
             print("Saving morphoframe in %s"%(main_save_filepath))
-            io.save_obj(self.morphoframe[morphoframe_name], main_save_filepath)
+            self._save_morphoframe(self.morphoframe[morphoframe_name], main_save_filepath, save_format)
             print("The morphoframe is saved in %s" %(main_save_filepath))
 
             # Save name of failed files in .txt
@@ -300,6 +330,8 @@ class Pipeline(object):
             morphoframe_filepath (str or 0): If not 0, must contain the filepath to the morphoframe which will then be saved into morphoframe_name.
             filtration_function (str): This is the TMD filtration function, can either be radial_distance, or path_distance.
             exclude_sg_branches (bool): if you want to remove the branches link to the soma that do not have ramifications i.e. simple trunks.
+            n_jobs (int): Number of worker processes computing the barcodes, -1 uses all the cpus.
+            chunksize (int or 0): Number of cells sent at once to a worker, if 0 it is set from the number of cells.
             morphoframe_name (str): This is how the variable in self.morphoframe will be called.
             save_data (bool): Trigger to save output of protocol.
             save_folderpath (str): Location where to save the variable.
@@ -316,6 +348,8 @@ class Pipeline(object):
         morphoframe_name = params["morphoframe_name"]
 
         filtration_function = params["filtration_function"]
+        n_jobs = params["n_jobs"]
+        chunksize = params["chunksize"]
         
         save_data = params["save_data"]
         save_folderpath = params["save_folderpath"]
@@ -339,7 +373,10 @@ class Pipeline(object):
         my_population = Population(cells_frame = cells)
 
         print("Computing the TMD on morphoframe %s"%(morphoframe_name))
-        my_population.set_barcodes(filtration_function = filtration_function, from_trees = False)
+        my_population.set_barcodes(filtration_function = filtration_function, 
+                                   from_trees = False, 
+                                   n_jobs = n_jobs, 
+                                   chunksize = chunksize)
         _morphoframe = my_population.cells
 
         # Merge back
@@ -622,6 +659,7 @@ class Pipeline(object):
             k_elements (int or ratio): The number of elements that will be subsampled to generate a subbarcode or subtree.
             n_samples (int): Number of subbarcodes per barcode.
             rand_seed (int): Seed of the random number generator.
+            n_jobs (int): Number of worker processes, -1 uses all the cpus. The subsamples do not depend on it.
             extendedframe_name (str): Where the subsampled morphoframe will be stored.
             save_data (bool): Trigger to save output of protocol.
             save_folderpath (str): Location where to save the data.
@@ -641,6 +679,7 @@ class Pipeline(object):
         n_samples = params["n_samples"]
 
         rand_seed = params["rand_seed"]
+        n_jobs = params["n_jobs"]
 
         save_data = params["save_data"]
         save_folderpath = params["save_folderpath"]
@@ -666,7 +705,8 @@ class Pipeline(object):
                                                                                         k_elements = k_elements, 
                                                                                         n_samples = n_samples, 
                                                                                         rand_seed = rand_seed,
-                                                                                        main_branches = main_branches)
+                                                                                        main_branches = main_branches,
+                                                                                        n_jobs = n_jobs)
         else:
             _type = params['type']
             number = params['nb_sections']
@@ -675,14 +715,16 @@ class Pipeline(object):
                                                                                     _type = _type,
                                                                                     number = number,
                                                                                     n_samples = n_samples, 
-                                                                                    rand_seed = rand_seed,)
+                                                                                    rand_seed = rand_seed,
+                                                                                    n_jobs = n_jobs,)
                 
             if feature_to_subsample == "cells":
                 _morphoframe_copy[feature_to_subsample] = subsampler.subsample_cells(cell_list = features,
                                                                                     _type = _type,
                                                                                     number = number,
                                                                                     n_samples = n_samples, 
-                                                                                    rand_seed = rand_seed,)
+                                                                                    rand_seed = rand_seed,
+                                                                                    n_jobs = n_jobs,)
 
         # initialize output filename
         default_save_filename = "Subsampled"
@@ -718,6 +760,9 @@ class Pipeline(object):
             n_samples (int): Number of sampled points to create a bootstrapped point.
             ratio (float): Only used if n_samples = 0. A number between 0 and 1, defines the number of samples per population with respect to the pop size. 
             replacement (bool): When sampling to average for bootstrap, is it a sampling with or without replacement.
+            bootstrap_method (str): How the samples of a bag are aggregated for scalar and array features: mean, median, max or min.
+            memory_budget (int or None): If set, the bags are aggregated by blocks whose temporary arrays stay below this number of bytes.
+            n_jobs (int): Number of worker processes drawing the blocks of bags, -1 uses all the cpus. The bags do not depend on it.
             bootstrapframe_name (str): Where the bootstrapped morphoframe will be stored.
             save_data (bool): Trigger to save output of protocol.
             save_folderpath (str): Location where to save the data.
@@ -742,8 +787,11 @@ class Pipeline(object):
         n_samples = params["n_samples"]
         ratio = params["ratio"]
         replacement = params["replacement"]
+        bootstrap_method = params["bootstrap_method"]
+        memory_budget = params["memory_budget"]
 
         rand_seed = params["rand_seed"]
+        n_jobs = params["n_jobs"]
 
         bootstrapframe_name = params["bootstrapframe_name"]
         save_data = params["save_data"]
@@ -774,6 +822,9 @@ class Pipeline(object):
                 n_samples = n_samples,
                 ratio = ratio,
                 rand_seed = rand_seed,
+                bootstrap_method = bootstrap_method,
+                memory_budget = memory_budget,
+                n_jobs = n_jobs,
             )
         )
 
@@ -916,10 +967,15 @@ class Pipeline(object):
             pixel_std_cutoff (str): how to normalize the persistence image, can be "sum" or "max"
             normalize (bool): normalize data before reduction
             standardize (bool): standardize data before reduction
+            batch_size (int): number of vectors normalized and standardized at once
             save_data (bool): trigger to save output of protocol
             save_folderpath (str): location where to save the data
             save_filename (str or 0): This will be used as the file name.
 
+        The vectors are written in a memory-mapped temporary file, normalized and standardized in place by blocks
+        of batch_size rows. An incremental pca reads them from this file, the other reducers get them in memory.
+        The file is deleted once the vectors are reduced.
+
         Returns
         -------
         Add a list of reduced vectors to a morphoframe. A row per sample (example: microglia), the colums are the dimensions of the reduced vectors (result of the dimensionality reduction).
@@ -935,6 +991,7 @@ class Pipeline(object):
         filter_pixels = params["filter_pixels"]
         normalize = params['normalize']
         standardize = params['standardize']
+        batch_size = params['batch_size']
 
         save_data = params["save_data"]
         save_folderpath = params["save_folderpath"]
@@ -959,8 +1016,6 @@ class Pipeline(object):
 
             _morphoframe_copy[vectors_to_reduce] = _morphoframe_copy[vectors_to_reduce].apply(normalize_array)
 
-        X = np.stack(_morphoframe_copy[vectors_to_reduce])
-        
         dimred_methods = dimred_method_parameters.keys()
         dimred_method_names = '_'.join(list(dimred_methods))
         # define output filename
@@ -970,45 +1025,70 @@ class Pipeline(object):
                                               save_filename = save_filename,
                                               default_save_filename = default_save_filename, 
                                               save_data = save_data)
-        # if persistence image, pixels can be filtered 
-        if filter_pixels:
-            filtered_image = self._image_filtering(persistence_images = X,
-                                                  params = params, 
-                                                  save_filepath = save_filepath)
-            X = filtered_image
-
-        # normalize data 
-        if normalize and len(X[0].shape) == 1:
-            print("Normalize the vectors")
-            normalizer = Normalizer()
-            X = normalizer.fit_transform(X)
-            self.metadata['normalizer'] = normalizer
 
-        # standardize data 
-        if standardize:
-            print("Standardize the vectors")
-            standardize = StandardScaler()
-            X = standardize.fit_transform(X)
-            self.metadata['standardizer'] = standardize
-
-
-        print("Reduces the vectors with the following techniques %s " %(dimred_method_names))
-        # initialize an instance of DimReducer
-        dimreducer = DimReducer(tmd_vectors = X,
-                                dimred_parameters = dimred_method_parameters)
-        
-        # dim reduce the vectors
-        fit_dimreducers = []
-        for dimred_method in dimred_methods:
-            perform_dimred_method = getattr(dimreducer, dimred_method)
-            if dimred_method == 'vae' or dimred_method == 'vaecnn':
-                fit_dimreducer, reduced_vectors, mse = perform_dimred_method()
+        with tempfile.TemporaryDirectory() as vectors_folderpath:
+            # the vectors are written row by row in a memory-mapped file instead of being stacked in memory
+            if len(_morphoframe_copy[vectors_to_reduce].iloc[0].shape) == 1:
+                vectors_filepath = store.save_vectors(vectors = list(_morphoframe_copy[vectors_to_reduce]),
+                                                      filepath = os.path.join(vectors_folderpath, vectors_to_reduce),
+                                                      dtype = np.float64)
+                X = store.load_vectors(vectors_filepath, mmap_mode = "r+")
             else:
-                fit_dimreducer, reduced_vectors = perform_dimred_method()
-
-            fit_dimreducers.append(fit_dimreducer)
-   
-            dimreducer.tmd_vectors = reduced_vectors
+                X = np.stack(_morphoframe_copy[vectors_to_reduce])
+                if not np.issubdtype(X.dtype, np.floating):
+                    X = X.astype(float)
+
+            # if persistence image, pixels can be filtered 
+            if filter_pixels:
+                filtered_image = self._image_filtering(persistence_images = X,
+                                                      params = params, 
+                                                      save_filepath = save_filepath)
+                X = filtered_image
+
+            blocks = [(beg, min(beg + batch_size, len(X))) for beg in range(0, len(X), batch_size)]
+            # normalize data 
+            if normalize and len(X[0].shape) == 1:
+                print("Normalize the vectors")
+                normalizer = Normalizer().fit(X[:batch_size])
+                for beg, end in blocks:
+                    X[beg:end] = normalizer.transform(X[beg:end])
+                self.metadata['normalizer'] = normalizer
+
+            # standardize data 
+            if standardize:
+                print("Standardize the vectors")
+                standardize = StandardScaler()
+                for beg, end in blocks:
+                    standardize.partial_fit(X[beg:end])
+                for beg, end in blocks:
+                    X[beg:end] = standardize.transform(X[beg:end])
+                self.metadata['standardizer'] = standardize
+
+            # only an incremental pca reads the memory-mapped vectors by blocks, the other reducers load them
+            # anyway and some keep their training data (e.g. umap), which would keep the temporary file open
+            first_method = next(iter(dimred_methods), None)
+            streamed = first_method == "pca" and dimred_method_parameters["pca"].get("pca_version") == "incremental"
+            if isinstance(X, np.memmap) and not streamed:
+                X = np.array(X)
+
+            print("Reduces the vectors with the following techniques %s " %(dimred_method_names))
+            # initialize an instance of DimReducer
+            dimreducer = DimReducer(tmd_vectors = X,
+                                    dimred_parameters = dimred_method_parameters)
+            
+            # dim reduce the vectors
+            fit_dimreducers = []
+            for dimred_method in dimred_methods:
+                perform_dimred_method = getattr(dimreducer, dimred_method)
+                if dimred_method == 'vae' or dimred_method == 'vaecnn':
+                    fit_dimreducer, reduced_vectors, mse = perform_dimred_method()
+                else:
+                    fit_dimreducer, reduced_vectors = perform_dimred_method()
+
+                fit_dimreducers.append(fit_dimreducer)
+       
+                dimreducer.tmd_vectors = reduced_vectors
+            del X, dimreducer
         
         if "mse" in self.metadata.keys():
             self.metadata['mse'] = mse
@@ -7,8 +7,14 @@ import numpy as np
 import pandas as pd
 from scipy.cluster.hierarchy import linkage, fcluster
 from math import comb
+from functools import partial
 from itertools import combinations
 
+from morphomics.utils import concatenated_ranges, parallel_map, spawn_seeds
+
+# Number of bags drawn from the same random stream, the blocks of bags are the units of parallel work
+BAGS_PER_BLOCK = 1000
+
 bootstrap_methods = {
     "mean": lambda arr: np.mean(arr),
     "median": lambda arr: np.median(arr),
@@ -39,45 +45,169 @@ def extract_and_convert(input_string):
         return None
     
 
-def _bootstrap_feature(bootstrap_bag, feature_type, bootstrap_method = bootstrap_methods["mean_axis"]):
-    '''The function `_bootstrap_feature` collects bars or averages over features based on the specified
-    data type.
-    
+def _draw_bags(rng, pop_length, N_bags, size, replacement, probabilities=None):
+    '''Draws the samples of all the bags at once.
+
     Parameters
     ----------
-    _b_frame
-        The `_b_frame` parameter is likely a DataFrame or a similar data structure that contains the data
-    for analysis. It could be used to store information about the features being analyzed, such as
-    measurements or characteristics of a sample.
-    morphology_list
-        The `morphology_list` parameter likely contains a list of morphology features or characteristics
-    that are used in the bootstrapping process. These features could include measurements such as
-    length, width, area, volume, etc., depending on the context of the code and the specific application
-    it is being used for.
-    _feature
-        The `_feature` parameter is a feature that is being used in the `_bootstrap_feature` function. It
-    is a specific attribute or characteristic that is being analyzed or processed within the function.
-    _dtype
-        The `_dtype` parameter is used to specify the type of data being processed. In this code snippet,
-    it is checked to determine whether the data type is "bars" or not, and different functions are
-    called based on this condition.
-    
+    rng (np.random.Generator): the random number generator.
+    pop_length (int): the number of morphologies in the population.
+    N_bags (int): the number of bags.
+    size (int): the number of samples per bag.
+    replacement (bool): whether a morphology can be sampled several times in a bag.
+    probabilities (np.array): (N_bags, pop_length), the probability of each morphology in each bag,
+                              uniform if None.
+
     Returns
     -------
-        The function `_bootstrap_feature` returns the `bootstrapped_feature` variable, which is either the
-    result of `_collect_bars` function if the `_dtype` is "bars", or the result of
-    `_average_over_features` function if `_dtype` is not "bars".
-    
+    positions (np.array): (N_bags, size), the positions in the population of the samples of each bag.
     '''
-    if feature_type == "bars":
-        bootstrapped_feature = bootstrap_bag
-    elif feature_type == "array":
-        bootstrapped_feature = bootstrap_method(bootstrap_bag, 0)
+    if probabilities is None:
+        if replacement:
+            return rng.integers(pop_length, size=(N_bags, size))
+        # Each bag draws only its own samples, without shuffling the whole population
+        positions = np.empty((N_bags, size), dtype=np.int64)
+        for bag_positions in positions:
+            bag_positions[:] = rng.choice(pop_length, size, replace=False)
+        return positions
+
+    if not replacement:
+        return np.array([rng.choice(pop_length, size, replace=False, p=p) for p in probabilities])
+
+    # Inverse transform sampling, all the bags searched at once by shifting bag i by i
+    cdf = np.cumsum(probabilities, axis=1)
+    cdf /= cdf[:, -1:]
+    shifts = np.arange(N_bags)[:, None]
+    uniform_samples = rng.random((N_bags, size))
+    positions = np.searchsorted((cdf + shifts).ravel(), (uniform_samples + shifts).ravel(), side="right")
+    return np.minimum(positions.reshape(N_bags, size) - shifts * pop_length, pop_length - 1)
+
+
+def _streamed_aggregates(stacked_features, positions, bootstrap_method, memory_budget):
+    '''Aggregates the features of the bags without gathering all their samples.
+
+    The bags are processed in blocks. For the mean, max and min, the samples of a block are read one
+    column of positions at a time and accumulated in place, so a block holds two feature rows per bag.
+    The median needs all the samples of a bag and a block holds them. The blocks are sized so that
+    these temporary arrays stay below memory_budget bytes, one bag per block at least.
+
+    Parameters
+    ----------
+    stacked_features (np.array): (pop_length, feature_size), the features of the population.
+    positions (np.array): (N_bags, size), the positions in the population of the samples of each bag.
+    bootstrap_method (str): the aggregation, a key in bootstrap_methods.
+    memory_budget (int): the maximal size in bytes of the temporary arrays.
+
+    Returns
+    -------
+    aggregates (np.array): (N_bags, feature_size), the aggregated features of each bag.
+    '''
+    N_bags, size = positions.shape
+    if bootstrap_method == "mean" and not np.issubdtype(stacked_features.dtype, np.inexact):
+        dtype = np.float64
     else:
-        bootstrapped_feature = bootstrap_method(bootstrap_bag)
+        dtype = stacked_features.dtype
+    row_bytes = stacked_features.shape[1] * max(stacked_features.itemsize, np.dtype(dtype).itemsize)
+    bag_bytes = row_bytes * (size if bootstrap_method == "median" else 2)
+    block_size = max(1, int(memory_budget // max(bag_bytes, 1)))
+
+    accumulate = {"mean": np.add, "max": np.maximum, "min": np.minimum}
+    aggregates = np.empty((N_bags, stacked_features.shape[1]), dtype=dtype)
+    for beg in range(0, N_bags, block_size):
+        bags_positions = positions[beg:beg + block_size]
+        if bootstrap_method == "median":
+            aggregates[beg:beg + block_size] = np.median(stacked_features[bags_positions], axis=1)
+            continue
+        block_aggregates = aggregates[beg:beg + block_size]
+        block_aggregates[:] = stacked_features[bags_positions[:, 0]]
+        for sample in range(1, size):
+            accumulate[bootstrap_method](block_aggregates, stacked_features[bags_positions[:, sample]],
+                                         out=block_aggregates)
+        if bootstrap_method == "mean":
+            block_aggregates /= size
+    return aggregates
+
+
+def _stack_population(features, feature_type):
+    '''Stacks the features of a population once, to be shared by all its blocks of bags.
+
+    Returns
+    -------
+    stacked_features (np.array): (pop_length, feature_size) the stacked features, or all the bars
+                                 of the population for "bars".
+    nb_bars (np.array): (pop_length,) the number of bars of each morphology for "bars", else None.
+    '''
+    if feature_type == "bars":
+        return np.vstack(features), np.array([len(bars_) for bars_ in features], dtype=np.int64)
+    return np.vstack(features), None
 
-    return bootstrapped_feature
 
+def _bootstrap_bags(population, positions, feature_type, bootstrap_method="mean", memory_budget=None):
+    '''Collects the bars or aggregates the features of all the bags.
+
+    Parameters
+    ----------
+    population (tuple): the stacked features of the population, as returned by _stack_population.
+    positions (np.array): (N_bags, size), the positions in the population of the samples of each bag.
+    feature_type (str): "bars" to collect the bars of the samples of each bag, "array" to aggregate
+                        them element-wise and "scalar" to aggregate all their values.
+    bootstrap_method (str): the aggregation, a key in bootstrap_methods.
+    memory_budget (int): if set, the features are aggregated by _streamed_aggregates within this
+                         number of bytes, instead of gathering the samples of all the bags at once.
+                         The gather holds N_bags * size * feature_size values, N_bags being at most
+                         BAGS_PER_BLOCK; set memory_budget to bound it for large bags or features.
+
+    Returns
+    -------
+    bootstrapped_features (list): the bars or the aggregated feature of each bag.
+    '''
+    stacked_features, nb_bars = population
+    if feature_type == "bars":
+        ends = np.cumsum(nb_bars)
+        sampled = positions.ravel()
+        bags_bars = stacked_features[concatenated_ranges(ends[sampled] - nb_bars[sampled], ends[sampled])]
+        bags_ends = np.cumsum(nb_bars[positions].sum(axis=1))
+        return np.split(bags_bars, bags_ends[:-1])
+
+    if memory_budget:
+        aggregates = _streamed_aggregates(stacked_features, positions, bootstrap_method, memory_budget)
+        return list(aggregates) if feature_type == "array" else list(aggregates[:, 0])
+
+    # One gather of the stacked features, then one reduction over the samples of each bag.
+    # The gather is an (N_bags, size, feature_size) array, unbounded by any budget.
+    sampled_features = stacked_features[positions]
+    axis = 1 if feature_type == "array" else (1, 2)
+    return list(bootstrap_methods[bootstrap_method + "_axis"](sampled_features, axis))
+
+
+# The stacked populations of the conditions, sent once per worker by _share_populations
+_populations = None
+
+
+def _share_populations(populations):
+    global _populations
+    _populations = populations
+
+
+def _bootstrap_block(block, feature_type, replacement, bootstrap_method, memory_budget):
+    '''Draws and aggregates a block of bags of a population with the random stream of the block.
+
+    Parameters
+    ----------
+    block (tuple): the index of the population in the shared populations, the number of bags, their size,
+                   the (N_bags, pop_length) probabilities of the morphologies or None, and the SeedSequence
+                   of the block.
+
+    Returns
+    -------
+    positions (np.array): (N_bags, size), the positions in the population of the samples of each bag.
+    bootstrapped_features (list): the bars or the aggregated feature of each bag.
+    '''
+    population_idx, N_bags, size, probabilities, seed = block
+    population = _populations[population_idx]
+    pop_length = len(population[1]) if feature_type == "bars" else len(population[0])
+    positions = _draw_bags(np.random.default_rng(seed), pop_length, N_bags, size, replacement, probabilities)
+    return positions, _bootstrap_bags(population, positions, feature_type, bootstrap_method, memory_budget)
 
 
 def get_bootstrap_frame(
@@ -91,8 +221,10 @@ def get_bootstrap_frame(
     n_samples,
     rand_seed=None,
     ratio=None,
+    bootstrap_method="mean",
+    memory_budget=None,
+    n_jobs=1,
 ):
-    np.random.seed(rand_seed)
 
     _feature, _dtype = feature_to_bootstrap
     assert (
@@ -117,8 +249,11 @@ def get_bootstrap_frame(
     _info_frame['condition'] = _info_frame[bootstrap_conditions].apply(lambda x: '-'.join(x), axis=1)
     condition_list = _info_frame['condition'].unique()
 
-    bootstrap_frame_list = []
-    for condition in condition_list:
+    # Each condition has its own random stream, split in one stream per block of bags, so that the
+    # bags only depend on rand_seed whatever the number of workers.
+    condition_seeds = spawn_seeds(rand_seed, len(condition_list))
+    blocks, block_conditions, condition_pop_idxs, condition_bins, populations = [], [], [], [], []
+    for condition, condition_seed in zip(condition_list, condition_seeds):
         print("Performing bootstrapping for %s..." % condition)
         # Get the lis of the indxs of the samples from the condition
         pop_idxs = _info_frame.loc[_info_frame["condition"] == condition].index
@@ -135,36 +270,53 @@ def get_bootstrap_frame(
             min_val, max_val = _info_frame.loc[pop_idxs][numeric_condition].min(), _info_frame.loc[pop_idxs][numeric_condition].max()
             bins = np.linspace(min_val, max_val, N_bags)
             bins = [int(b) for b in bins]
-            sampled_idxs_list = []
-            for i in range(N_bags):
-                bag_value = bins[i]
-                time_diffs = np.abs(_info_frame.loc[pop_idxs]["Time"] - bag_value)
-                # Compute probabilities by evaluating under a Gaussian distribution
-                probabilities = np.exp(-time_diffs ** 2 / (2 * numeric_condition_std ** 2))
-                probabilities /= probabilities.sum()  # Normalize to create a probability distribution
-                
-
-                sampled_idxs = np.random.choice(pop_idxs, n_samples, replace=replacement, p=probabilities)
-                sampled_idxs_list.append(sampled_idxs)
+            time_diffs = np.abs(_info_frame.loc[pop_idxs]["Time"].values[None, :] - np.array(bins)[:, None])
+            # Compute probabilities by evaluating under a Gaussian distribution
+            probabilities = np.exp(-time_diffs ** 2 / (2 * numeric_condition_std ** 2))
+            probabilities /= probabilities.sum(axis=1, keepdims=True)  # Normalize to create a probability distribution
+            _size = n_samples
 
         else:
+            bins, probabilities = None, None
             # Get the list of the bags. A bag is composed of randomly chose sampled indcs.    
             # But if the nb of samples is higher than the size of the pop, n_samples is reajusted.
             if not replacement and n_samples > pop_length:
                 _size = pop_length
             else:
                 _size = n_samples
-            
-            sampled_idxs_list = [np.random.choice(pop_idxs, size = _size, replace=replacement) 
-                                for _ in range(N_bags)]
-
-        bootstraped_bag_list = []
-        # Iterate through the N_bags.
-        for sampled_idxs in sampled_idxs_list:
-            bootstrap_bag = _info_frame.loc[sampled_idxs][feature_to_bootstrap[0]]
-            bootstrap_bag =  np.vstack(bootstrap_bag)
-            bootstraped_bag = _bootstrap_feature(bootstrap_bag, feature_to_bootstrap[1])
-            bootstraped_bag_list.append(bootstraped_bag)
+
+        # The features are stacked once and sent once per worker, the blocks only refer to them
+        populations.append(_stack_population(list(_info_frame.loc[pop_idxs, feature_to_bootstrap[0]]),
+                                             feature_to_bootstrap[1]))
+        block_starts = range(0, N_bags, BAGS_PER_BLOCK)
+        for beg, block_seed in zip(block_starts, condition_seed.spawn(len(block_starts))):
+            end = min(beg + BAGS_PER_BLOCK, N_bags)
+            block_probabilities = probabilities[beg:end] if probabilities is not None else None
+            blocks.append((len(condition_pop_idxs), end - beg, _size, block_probabilities, block_seed))
+            block_conditions.append(len(condition_pop_idxs))
+        condition_pop_idxs.append(pop_idxs)
+        condition_bins.append(bins)
+
+    bootstrapped_blocks = parallel_map(partial(_bootstrap_block,
+                                               feature_type=feature_to_bootstrap[1],
+                                               replacement=replacement,
+                                               bootstrap_method=bootstrap_method,
+                                               memory_budget=memory_budget),
+                                       blocks, n_jobs=n_jobs,
+                                       initializer=_share_populations, initargs=(populations,))
+    condition_positions = [[] for _ in condition_list]
+    condition_bags = [[] for _ in condition_list]
+    for condition_idx, (positions, bootstraped_bags) in zip(block_conditions, bootstrapped_blocks):
+        condition_positions[condition_idx].append(positions)
+        condition_bags[condition_idx].extend(bootstraped_bags)
+    _share_populations(None)
+
+    bootstrap_frame_list = []
+    for condition, pop_idxs, bins, positions, bootstraped_bag_list in zip(condition_list, condition_pop_idxs,
+                                                                        condition_bins, condition_positions,
+                                                                        condition_bags):
+        positions = np.concatenate(positions) if len(positions) > 0 else np.zeros((0, 0), dtype=np.int64)
+        sampled_idxs_list = list(np.asarray(pop_idxs)[positions])
         
         condition_bootstrap_frame = pd.DataFrame(
             columns = bootstrap_conditions + ['condition', 'bootstrap_indices', feature_to_bootstrap[0]]
@@ -16,6 +16,7 @@ class DefaultParams:
                                                         'std_isotropic': 0.1,
                                                         'bw_method':None,
                                                         'barcode_weight': None,
+                                                        'n_jobs': 1,
                                                         },
                                   'curve': self.general_vect_params,
                                   'lifespan_curve': self.general_vect_params,
@@ -37,6 +38,8 @@ class DefaultParams:
         self.dimreducer_params = {'pca': {"n_components": 20,
                                           "svd_solver": False,
                                           "pca_version": 'standard',
+                                          "batch_size": None,
+                                          "memory_budget": None,
                                             },
                                     'umap': {"n_neighbors": 50,
                                              "n_components": 2,
@@ -74,8 +77,12 @@ class DefaultParams:
                                             "extension": '.swc',
                                             "conditions": ['Region', 'Model', 'Sex', 'Animal'],
                                             "separated_by": None,
+                                            "n_jobs": 1,
+                                            "save_format": 'pkl',
                                             },
                                 'TMD': {"filtration_function": 'radial_distance',
+                                        "n_jobs": 1,
+                                        "chunksize": 0,
                                         },
                                 'Clean_frame': {"combine_conditions": [],
                                                 "restrict_conditions": []
@@ -91,6 +98,7 @@ class DefaultParams:
                                                 "feature_to_subsample": 'barcodes',
                                                 "n_samples": 20,
                                                 "rand_seed": 51,
+                                                "n_jobs": 1,
                                                 
                                                 "main_branches": 'keep',
                                                 "k_elements": 0.9,
@@ -105,7 +113,10 @@ class DefaultParams:
                                                 "n_samples": 20,
                                                 "ratio": 0,
                                                 "replacement": True,
+                                                "bootstrap_method": "mean",
+                                                "memory_budget": None,
                                                 "rand_seed": None,
+                                                "n_jobs": 1,
                                                 "bootstrapframe_name": 'bootstraped_microglia',
                                             },
                                 'Vectorizations': {"vect_method_parameters": self.vectorizer_params,
@@ -116,6 +127,7 @@ class DefaultParams:
                                                     "filter_pixels": False,
                                                     "normalize": False,
                                                     "standardize": False,
+                                                    "batch_size": 1000,
                                                     "save_dimreducer": False,
                                                     "FilteredPixelIndex_filepath": False,
                                                     "pixel_std_cutoff": 1e-5
@@ -1,6 +1,6 @@
 import numpy as np
 from morphomics.protocols.default_parameters import DefaultParams
-from sklearn.decomposition import PCA, KernelPCA, TruncatedSVD, TruncatedSVD
+from sklearn.decomposition import PCA, KernelPCA, TruncatedSVD, TruncatedSVD, IncrementalPCA
 import umap
 from sklearn.manifold import TSNE
 from morphomics.nn_models import vae, criterion, cocob, train_test
@@ -15,7 +15,8 @@ class DimReducer(object):
 
         Parameters
         ----------
-        tmd_vectors (np.array): array containing vectors, one vector per sample in row.
+        tmd_vectors (np.array or str): array containing vectors, one vector per sample in row,
+                            or the path of a .npy file of vectors that is memory-mapped.
         dimred_parameters (dict): contains the parameters for each dim reduction techniques that would be run in sequence.
                             dimred_parameters = {'dimred_method_1 : { parameter_1_1: x_1_1, ..., parameter_1_n: x_1_n},
                                                 ...
@@ -26,11 +27,49 @@ class DimReducer(object):
         -------
         An instance of DimReducer.
         """
+        if isinstance(tmd_vectors, str):
+            tmd_vectors = np.load(tmd_vectors, mmap_mode = "r")
         self.tmd_vectors = tmd_vectors
         self.dimred_parameters = dimred_parameters
         self.default_params = DefaultParams()
 
     ## Private
+    def _row_blocks(self, batch_size, min_rows):
+        ''' Splits the rows of tmd_vectors in consecutive blocks of batch_size rows.
+        A last block smaller than min_rows is merged with the previous one.
+        '''
+        nb_rows = len(self.tmd_vectors)
+        bounds = list(range(0, nb_rows, batch_size)) + [nb_rows]
+        if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_rows:
+            del bounds[-2]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _incremental_pca(self, n_components, batch_size, memory_budget):
+        ''' Fits an IncrementalPCA on blocks of rows of tmd_vectors and reduces them block by block.
+
+        Only one block of rows is read at a time, so tmd_vectors can be memory-mapped.
+        If batch_size is None, it is set from memory_budget, in bytes: a fit on a block of b rows and
+        n features holds about 8 float64 copies of the (b + n_components, n) stacked block.
+        '''
+        nb_rows, nb_features = self.tmd_vectors.shape
+        # partial_fit needs at least n_components rows per block, all the features if n_components is None
+        min_rows = n_components or nb_features
+        if batch_size is None:
+            if memory_budget:
+                batch_size = int(memory_budget // (8 * 8 * nb_features)) - min_rows
+            else:
+                batch_size = 5 * nb_features
+        batch_size = max(batch_size, min_rows)
+
+        fit_pca = IncrementalPCA(n_components = n_components, batch_size = batch_size)
+        blocks = self._row_blocks(batch_size, min_rows)
+        for beg, end in blocks:
+            fit_pca.partial_fit(np.asarray(self.tmd_vectors[beg:end], dtype = float))
+
+        reduced_vectors = np.empty((nb_rows, fit_pca.n_components_))
+        for beg, end in blocks:
+            reduced_vectors[beg:end] = fit_pca.transform(np.asarray(self.tmd_vectors[beg:end], dtype = float))
+        return fit_pca, reduced_vectors
 
 
     ## Public
@@ -42,8 +81,10 @@ class DimReducer(object):
         pca_params (dict): the parameters for the pca:
                             -n_components (int): Number of components to keep. if n_components is not set all components are kept.
                             -svd_solver (bool): Computes the exact SVD, otherwise the solver is selected by a default ‘auto’ policy defined by scikit learn.
-                            -pca_version (str): Select the type of pca.
+                            -pca_version (str): Select the type of pca, "incremental" fits it on blocks of rows.
                             -kernel (str): Kernel used for PCA.
+                            -batch_size (int): Number of rows per block for the incremental pca.
+                            -memory_budget (int): Bytes used by the incremental pca if batch_size is not set.
 
         Returns
         -------
@@ -64,6 +105,11 @@ class DimReducer(object):
         pca_version = pca_params["pca_version"]
         
         print("Running PCA...")
+        if pca_version == "incremental":
+            return self._incremental_pca(n_components = n_components,
+                                         batch_size = pca_params["batch_size"],
+                                         memory_budget = pca_params["memory_budget"])
+
         if pca_version == "kernel":
             kernel = pca_params["kernel"]
             fit_pca = KernelPCA(n_components = n_components, kernel = kernel, eigen_solver = svd_solver)
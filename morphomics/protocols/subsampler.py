@@ -1,101 +1,120 @@
+from functools import partial
+
 import numpy as np
+import pandas as pd
 from morphomics.cells.neuron import Neuron
+from morphomics.utils import parallel_map, spawn_seeds
 
 ## Barcodes
 
 def set_proba(feature_list, main_branches = None):
     # Define probas of picking for each element of a feature.
     if main_branches == 'keep' or main_branches == 'remove':
-        feature_list = feature_list.apply(lambda ph: np.array([bar if np.all(bar >= 0.001) else [0, 0] for bar in ph]))
+        feature_list = feature_list.apply(lambda ph: np.where(np.all(ph >= 0.001, axis=-1)[:, None], ph, 0.))
     
     bar_lengths = feature_list.apply(lambda ph: np.abs(ph[:, 1] - ph[:, 0]) if ph is not np.nan else np.nan)
 
     # The if is because some barcodes only have main branches (trunks) and thus the proba is 0
-    probas = bar_lengths.apply(lambda ph: ph/sum(np.sort(ph, axis=-1)) if sum(np.sort(ph, axis=-1))>1e-5 else np.zeros((len(ph))))
+    totals = bar_lengths.apply(lambda ph: ph.sum() if len(ph) > 0 else 0.)
+    probas = pd.Series([ph/total if total>1e-5 else np.zeros((len(ph))) for ph, total in zip(bar_lengths, totals)],
+                       index = bar_lengths.index, dtype = object)
     return probas
 
+def _subsample_ph(item, k_elements, n_samples, main_branches):
+    # Subsample one feature n_samples time with its own random stream.
+    ph, proba, seed = item
+    rng = np.random.default_rng(seed)
+    ph = np.array(ph)
+    # Update the number of elements to subsample from morphology
+    if not isinstance(k_elements, int) :
+        k = max(1, int(k_elements * ph.shape[0]))
+    else:
+        k = k_elements
+
+    # Keep or remove the main branches
+    if main_branches == 'keep':
+        main_branches_mask = np.any(ph < 0.001, axis=-1)
+        main_branches_indices = np.where(main_branches_mask)[0]
+    else:
+        main_branches_indices = np.array([], dtype=int)
+
+    # Sample the bars of all the subsamples at once, by inverse transform sampling as in rng.choice
+    if np.sum(proba) > 0.9:
+        cdf = np.cumsum(proba)
+        cdf /= cdf[-1]
+        sampled_indices = cdf.searchsorted(rng.random((n_samples, k)), side='right')
+    else:
+        sampled_indices = np.zeros((n_samples, 0), dtype=int)
+    indices = np.hstack((sampled_indices, np.broadcast_to(main_branches_indices, (n_samples, len(main_branches_indices)))))
+    
+    subsamples = list(ph[indices])
+    return subsamples
+
 def subsample_phs_w_replacement(ph_list, probas, k_elements, n_samples, 
-                            rand_seed = None, main_branches = None):
+                            rand_seed = None, main_branches = None, n_jobs = 1):
     # Subsample each feature n_samples time, following probas, to create a list of subfeatures with k_elements.
-    if rand_seed is None:
-        np.random.seed(rand_seed)
-    subsampled_features = []
-    for ph, proba in zip(ph_list, probas):
-        ph = np.array(ph)
-        # Update the number of elements to subsample from morphology
-        if not isinstance(k_elements, int) :
-            k = max(1, int(k_elements * ph.shape[0]))
-        else:
-            k = k_elements
-
-        # Keep or remove the main branches
-        if main_branches == 'keep':
-            main_branches_mask = np.any(ph < 0.001, axis=-1)
-            main_branches_indices = np.where(main_branches_mask)[0]
-        else:
-            main_branches_indices = np.array([], dtype=int)
-
-        # Sample the 
-        indices_list = [np.hstack(([np.random.choice(len(proba), p=proba) for _ in range(k)] if sum(proba) > 0.9 else [], main_branches_indices)) 
-                        for _ in range(n_samples)] 
-        
-        subsamples = [ph[indices.astype(int)] for indices in indices_list]
-        subsampled_features.append(subsamples)
+    # Each feature has its own random stream spawned from rand_seed, the subsamples do not depend on n_jobs.
+    seeds = spawn_seeds(rand_seed, len(ph_list))
+    subsampled_features = list(parallel_map(partial(_subsample_ph, k_elements = k_elements, n_samples = n_samples, 
+                                                    main_branches = main_branches),
+                                            zip(ph_list, probas, seeds), n_jobs = n_jobs))
     return subsampled_features
 
 ## Trees
 
-def subsample_trees(tree_list, _type, number, n_samples, rand_seed = None):
+def _subsample_tree(item, _type, number, n_samples):
+    # The samples are drawn from a view, that shares the node arrays and the topology,
+    # only the subsampled trees allocate new arrays.
+    tree, seed = item
+    rng = np.random.default_rng(seed)
+    tree_view = tree.view()
+    sub_tree_list = []
+    for _ in range(n_samples):
+        sub_tree = tree_view.subsample_tree(_type, number, rng = rng)
+        sub_tree_list.append(sub_tree)
+    return sub_tree_list
+
+def subsample_trees(tree_list, _type, number, n_samples, rand_seed = None, n_jobs = 1):
     #_type can be 'cut' or 'prune'
     # if cut then n_samples is 1 because it is deterministic
     # and number is:
         # if _type = prune then number is either the number of nodes to remove or the probability to remove a node
         # if _type = cut then the number is 
-    if rand_seed is not None:
-        np.random.seed(rand_seed)
-
     if _type == 'cut':
         n_samples = 1
 
+    seeds = spawn_seeds(rand_seed, len(tree_list))
+    subsampled_trees = list(parallel_map(partial(_subsample_tree, _type = _type, number = number, n_samples = n_samples),
+                                         zip(tree_list, seeds), n_jobs = n_jobs))
 
-    def subs(tree):
-        sub_tree_list = []
-        for _ in range(n_samples):
-            tree_copy = tree.copy_tree()
-            sub_tree = tree_copy.subsample_tree(_type, number)
-            sub_tree_list.append(sub_tree)
-        return sub_tree_list
-
-    subsampled_trees = tree_list.apply(subs)
+    return pd.Series(subsampled_trees, index = tree_list.index, dtype = object)
 
-    return subsampled_trees
 
+def _subsample_cell(item, _type, number, n_samples):
+    # combine_neurites builds a new Tree without modifying the cell, it is done once per cell
+    cell, seed = item
+    rng = np.random.default_rng(seed)
+    tree = cell.combine_neurites().neurites[0]
+    sub_neuron_list = []
+    for _ in range(n_samples):
+        sub_tree = tree.subsample_tree(_type, number, rng = rng)
+        neu = Neuron()
+        neu.append_tree(sub_tree)
+        neu.set_soma(cell.soma)
+        sub_neuron_list.append(neu)
+    return sub_neuron_list
 
-def subsample_cells(cell_list, _type, number, n_samples, rand_seed = None):
+def subsample_cells(cell_list, _type, number, n_samples, rand_seed = None, n_jobs = 1):
     #_type can be 'cut' or 'prune'
     # if cut then n_samples is 1 because it is deterministic
     # and number is:
         # if _type = prune then number is either the number of nodes to remove or the probability to remove a node
         # if _type = cut then the number is 
-    if rand_seed is not None:
-        np.random.seed(rand_seed)
-
     if _type == 'cut' or (_type == 'prune' and isinstance(number, int)):
         n_samples = 1
-    
-    def subs(cell):
-        sub_neuron_list = []
-        for _ in range(n_samples):
-            cell_copy = cell.copy_neuron()
-            cell_copy = cell_copy.combine_neurites()
-            tree = cell_copy.neurites[0]
-            sub_tree = tree.subsample_tree(_type, number)
-            neu = Neuron()
-            neu.append_tree(sub_tree)
-            neu.set_soma(cell.soma)
-            sub_neuron_list.append(neu)
-        return sub_neuron_list
-
-    subsampled_neurons = cell_list.apply(subs)
-
-    return subsampled_neurons
\ No newline at end of file
+
+    seeds = spawn_seeds(rand_seed, len(cell_list))
+    subsampled_neurons = list(parallel_map(partial(_subsample_cell, _type = _type, number = number, n_samples = n_samples),
+                                           zip(cell_list, seeds), n_jobs = n_jobs))
+
+    return pd.Series(subsampled_neurons, index = cell_list.index, dtype = object)
@@ -80,13 +80,16 @@ class Vectorizer(object):
 
     def _histogram_vectorization(self, 
                              hist_params,
-                             hist_method):
+                             hist_method,
+                             hists_method = None):
         '''General method to compute vectorization for histogram methods.
 
         Parameters
         ----------
         hist_method (method): the actual histogram like vectorization method, the method has 2 parameters: (bins, num_bins).
                                 example: betti_hist.
+        hists_method (method): the batched version of hist_method, used when all barcodes share the same bins.
+                                example: betti_hists.
         hist_params (dict): the parameters for the histogram vectorization:
                             -rescale_lims (bool): True: adapt the boundaries of the barcode for each barcode
                                                 False: choose the widest boundaries that include all barcodes 
@@ -114,15 +117,19 @@ class Vectorizer(object):
                 xlims = [np.min([_xlims[0], _ylims[0]]), np.max([_xlims[1], _ylims[1]])]
             bins = vectorizations._subintervals(xlims = xlims, num_bins = 1000)
         # Get the curve
-        hist_list = self.tmd.apply(lambda ph: hist_method(ph,
-                                                        bins = bins, 
-                                                        num_bins = num_bins)[0]
-        )
+        if bins is not None and hists_method is not None:
+            # All the histograms at once, a row per barcode
+            hist_list = list(hists_method(list(self.tmd), bins = bins))
+        else:
+            hist_list = self.tmd.apply(lambda ph: hist_method(ph,
+                                                            bins = bins, 
+                                                            num_bins = num_bins)[0]
+            )
         # normalize the curve
         norm_m = norm_methods[norm_method]
-        histograms = hist_list.apply(lambda hist: hist/norm_m(hist) if len(hist)>0 else np.nan)
+        histograms = [hist/norm_m(hist) if len(hist)>0 else np.nan for hist in hist_list]
 
-        return np.array(list(histograms))
+        return np.array(histograms)
     
 
     ## Public
@@ -157,10 +164,11 @@ class Vectorizer(object):
         weights for each barcode in the calculation of persistence images. If `barcode_weight` is provided,
         it will be used as weights for the corresponding barcode during the calculation. 
            The 'resolution' parameter is an integer that defines the number of pixels in a row and in a column of a persistence image.
+           The 'n_jobs' parameter is the number of worker processes computing the images, -1 uses all the cpus.
         
         Returns
         -------
-            The function returns a NumPy array of persistence images.
+            The function returns a float32 NumPy array of flattened persistence images, one per row.
         
 
         '''
@@ -180,7 +188,7 @@ class Vectorizer(object):
             barcode_weight = None
         norm_method=pi_params["norm_method"]
         resolution=pi_params["resolution"]
-        flatten = True
+        n_jobs=pi_params["n_jobs"]
 
         print("Computing persistence images...")
         
@@ -195,20 +203,20 @@ class Vectorizer(object):
             if ylims is None or ylims == "None":
                 ylims = _ylims
         
-        def vect_ph(ph):
-            return vectorizations.persistence_image(ph, method=pi_method, std_isotropic=std_isotropic, xlim = xlims, ylim = ylims, bw_method = bw_method, weights = barcode_weight, resolution = resolution)
-
-
-        pi_list = self.tmd.apply(vect_ph)
-
-        if flatten:
-            pi_list = pi_list.apply(lambda pi: pi.flatten())
-
-        norm_m = norm_methods[norm_method]
-        pis = pi_list.apply(lambda pi: pi/norm_m(pi) if len(pi)>0 else np.nan)
+        # The images are flattened and normalized in a (nb barcodes, resolution**2) float32 array
+        pis = vectorizations.persistence_images(list(self.tmd), 
+                                                method = pi_method, 
+                                                std_isotropic = std_isotropic, 
+                                                xlim = xlims, 
+                                                ylim = ylims, 
+                                                bw_method = bw_method, 
+                                                weights = barcode_weight, 
+                                                resolution = resolution,
+                                                norm_method = norm_method,
+                                                n_jobs = n_jobs)
     
         print("pi done! \n")
-        return np.array(list(pis))
+        return pis
 
 
     def betti_curve(self):
@@ -296,24 +304,7 @@ class Vectorizer(object):
         scaled_bar_lengths = self.tmd.apply(lambda x : get_lengths(x, type, density))
         maxL_SR = scaled_bar_lengths.apply(lambda x : max(x) if len(x)>0 else 0).max()
 
-        if bars_prob != "long" or bars_prob != "short":
-            # Faster vectorized implementation
-            x_values = np.linspace(0, maxL_SR, num=resolution)
-            # Count the maximum length of the numpy arrays in scaled_bar_lengths
-            max_length = max(scaled_bar_lengths.apply(len))
-
-            # Create a new numpy array with dimensions number of rows in scaled_bar_lengths times the max length
-            scaled_bar_lengths_array = np.zeros((len(scaled_bar_lengths), max_length)) - 1
-
-            # Insert scaled_bar_lengths into the new numpy array
-            for i, row in enumerate(scaled_bar_lengths):
-                scaled_bar_lengths_array[i, :len(row)] = row
-
-            srs = np.array([np.count_nonzero(scaled_bar_lengths_array >= disc, axis=1) for disc in x_values]).T
-
-        else:
-            stable_r = scaled_bar_lengths.apply(lambda x : vectorizations.stable_ranks(x, bars_prob, maxL_SR, resolution))
-            srs = np.array(list(stable_r))
+        srs = vectorizations.stable_ranks_batch(list(scaled_bar_lengths), bars_prob, maxL_SR, resolution)
 
         print("sr done! \n")
         return srs
@@ -336,7 +327,8 @@ class Vectorizer(object):
         betti_hist_params = self.vect_parameters["betti_hist"]
         print("Computing betti histograms...")
         betti_hists = self._histogram_vectorization(hist_params = betti_hist_params,
-                                                    hist_method = vectorizations.betti_hist)
+                                                    hist_method = vectorizations.betti_hist,
+                                                    hists_method = vectorizations.betti_hists)
         print("bh done! \n")
         return np.array(list(betti_hists))
 
@@ -358,7 +350,8 @@ class Vectorizer(object):
         lifespan_hist_params = self.vect_parameters["lifespan_hist"]
         print("Computing lifespan histograms...")
         lifespan_hists = self._histogram_vectorization(hist_params = lifespan_hist_params,
-                                                        hist_method = vectorizations.lifespan_hist)
+                                                        hist_method = vectorizations.lifespan_hist,
+                                                        hists_method = vectorizations.lifespan_hists)
         print("lh done! \n")
         return np.array(list(lifespan_hists))
 
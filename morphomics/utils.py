@@ -2,6 +2,9 @@
 Contains all the commonly used functions and data
 useful for multiple tmd modules.
 """
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 term_dict = {"x": 0, "y": 1, "z": 2}
@@ -27,7 +30,11 @@ scipy_metric = {
     "l2": "euclidean",
 }
 
-barcode_dist = {"bd": "bottleneck_distance"}
+barcode_dist = {
+    "bd": "bottleneck_distance",
+    "wd": "wasserstein_distance",
+    "sd": "distance_stepped",
+}
 
 norm_methods = {
     # Returns the normalization factor based on the norm_method
@@ -69,3 +76,55 @@ def inquire_numbers_per_layer(_info_frame):
             print(
                 _frame.loc[_frame.Time == timepoints].Region.value_counts(),
             )
+
+
+def concatenated_ranges(starts, stops):
+    """Returns the concatenation of the ranges [starts[i], stops[i]) without a python loop."""
+    starts, stops = np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64)
+    counts = stops - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(counts.sum()) + offsets
+
+
+def get_nb_workers(n_jobs):
+    """Returns the number of worker processes to use.
+    n_jobs <= 0 counts backwards from the number of cpus, i.e. -1 means all the cpus."""
+    nb_cpus = os.cpu_count() or 1
+    if n_jobs is None:
+        return 1
+    if n_jobs <= 0:
+        return max(1, nb_cpus + 1 + n_jobs)
+    return min(n_jobs, nb_cpus)
+
+
+def restore_nan(obj):
+    """Returns np.nan for None or any float NaN, and obj otherwise.
+    A np.nan pickled back from a worker process is a new float, which the `is np.nan` checks miss."""
+    if obj is None or (isinstance(obj, float) and np.isnan(obj)):
+        return np.nan
+    return obj
+
+
+def spawn_seeds(rand_seed, n):
+    """Returns n independent SeedSequences spawned from rand_seed, an int, None or a SeedSequence.
+    Each child only depends on rand_seed and on its rank, so the numbers drawn from
+    np.random.default_rng(child) do not depend on how the work is split between workers."""
+    if not isinstance(rand_seed, np.random.SeedSequence):
+        rand_seed = np.random.SeedSequence(rand_seed)
+    return rand_seed.spawn(n)
+
+
+def parallel_map(func, iterable, n_jobs=1, chunksize=1, initializer=None, initargs=()):
+    """Lazily maps func over iterable with n_jobs worker processes.
+    The results are yielded in the order of iterable, whatever the number of workers.
+    func must be picklable, i.e. defined at the top level of a module.
+    initializer(*initargs) is called once per worker (or once in this process without workers),
+    which sends the data shared by all the items once instead of once per item."""
+    nb_workers = get_nb_workers(n_jobs)
+    if nb_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(func, iterable)
+    else:
+        with ProcessPoolExecutor(max_workers=nb_workers, initializer=initializer, initargs=initargs) as executor:
+            yield from executor.map(func, iterable, chunksize=chunksize)
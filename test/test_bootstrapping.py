@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+import pandas as pd
+from morphomics.protocols import bootstrapping
+
+class TestBootstrapping(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.info_frame = pd.DataFrame({"Region": ["A"] * 6 + ["B"] * 4,
+                                        "Model": "M",
+                                        "Sex": "F",
+                                        "pi": [rng.random(5) for _ in range(10)],
+                                        "nb_bars": rng.random(10),
+                                        "barcodes": [rng.random((i % 3 + 1, 2)) for i in range(10)]})
+
+    def _bootstrap(self, feature_to_bootstrap, replacement=True, **kwargs):
+        return bootstrapping.get_bootstrap_frame(self.info_frame, feature_to_bootstrap, ["Region", "Model", "Sex"],
+                                                 False, 1.5, N_bags=7, replacement=replacement, n_samples=4,
+                                                 rand_seed=0, ratio=0, **kwargs)
+
+    def test_aggregates(self):
+        """Test the aggregates of the bags against their sampled rows"""
+        for feature, feature_type in (("pi", "array"), ("nb_bars", "scalar")):
+            for method in ("mean", "median", "max", "min"):
+                frame = self._bootstrap([feature, feature_type], bootstrap_method=method)
+                self.assertEqual(len(frame), 14)
+                for idxs, value in zip(frame["bootstrap_indices"], frame[feature]):
+                    expected = bootstrapping.bootstrap_methods[method + "_axis"](
+                        np.vstack(self.info_frame.loc[idxs, feature]), 0)
+                    np.testing.assert_allclose(np.ravel(value), np.ravel(expected))
+
+    def test_memory_budget(self):
+        """Test that the bags aggregated by blocks within a memory budget are the same"""
+        for method in ("mean", "median", "max", "min"):
+            frame = self._bootstrap(["pi", "array"], bootstrap_method=method)
+            streamed = self._bootstrap(["pi", "array"], bootstrap_method=method, memory_budget=100)
+            for idxs, value, streamed_idxs, streamed_value in zip(frame["bootstrap_indices"], frame["pi"],
+                                                                  streamed["bootstrap_indices"], streamed["pi"]):
+                np.testing.assert_array_equal(idxs, streamed_idxs)
+                np.testing.assert_allclose(value, streamed_value)
+
+    def test_reproducible(self):
+        """Test that the bags drawn by blocks with their own random streams only depend on the seed"""
+        frame = self._bootstrap(["pi", "array"])
+        block_size = bootstrapping.BAGS_PER_BLOCK
+        try:
+            bootstrapping.BAGS_PER_BLOCK = 2
+            blocks_frame = self._bootstrap(["pi", "array"])
+            blocks_frame_again = self._bootstrap(["pi", "array"])
+        finally:
+            bootstrapping.BAGS_PER_BLOCK = block_size
+        for idxs, blocks_idxs, blocks_idxs_again in zip(frame["bootstrap_indices"], blocks_frame["bootstrap_indices"],
+                                                        blocks_frame_again["bootstrap_indices"]):
+            self.assertEqual(len(idxs), len(blocks_idxs))
+            np.testing.assert_array_equal(blocks_idxs, blocks_idxs_again)
+
+    def test_bars(self):
+        """Test that the bars of the bags are the bars of their samples"""
+        frame = self._bootstrap(["barcodes", "bars"], replacement=False)
+        for idxs, bars in zip(frame["bootstrap_indices"], frame["barcodes"]):
+            self.assertEqual(len(np.unique(idxs)), 4)
+            np.testing.assert_array_equal(bars, np.vstack(self.info_frame.loc[idxs, "barcodes"]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from sklearn.decomposition import PCA
+from morphomics.io.store import save_vectors
+from morphomics.protocols.dim_reducer import DimReducer
+
+class TestDimReducer(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(103, 2)) * [5., 2.] @ rng.normal(size=(2, 8)) + 1.
+
+    def test_incremental_pca(self):
+        """Test the pca fitted on blocks of memory-mapped vectors against the pca of all the vectors"""
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = save_vectors(list(self.vectors), os.path.join(folder, "vectors"), dtype=np.float64)
+            dimreducer = DimReducer(filepath, {"pca": {"n_components": 2, "pca_version": "incremental",
+                                                       "batch_size": 25}})
+            self.assertIsInstance(dimreducer.tmd_vectors, np.memmap)
+            self.assertEqual(dimreducer._row_blocks(25, 2)[-1], (100, 103))
+            self.assertEqual(dimreducer._row_blocks(25, 5)[-1], (75, 103))
+            fit_pca, reduced_vectors = dimreducer.pca()
+
+        expected = PCA(n_components=2).fit(self.vectors)
+        np.testing.assert_allclose(fit_pca.explained_variance_, expected.explained_variance_, rtol=1e-6)
+        np.testing.assert_allclose(np.abs(reduced_vectors), np.abs(expected.transform(self.vectors)), atol=1e-6)
+        # The fitted pca is reused by the Mapping protocol
+        np.testing.assert_allclose(pickle.loads(pickle.dumps(fit_pca)).transform(self.vectors), reduced_vectors)
+
+    def test_incremental_pca_all_components(self):
+        """Test that all the components are kept with blocks smaller than the number of features"""
+        dimreducer = DimReducer(self.vectors, {"pca": {"n_components": None, "pca_version": "incremental",
+                                                       "batch_size": 5}})
+        fit_pca, reduced_vectors = dimreducer.pca()
+        self.assertEqual(reduced_vectors.shape, (103, 8))
+        expected = PCA().fit(self.vectors)
+        np.testing.assert_allclose(fit_pca.explained_variance_[:2], expected.explained_variance_[:2], rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+from itertools import permutations
+import numpy as np
+from scipy.spatial.distance import squareform
+from morphomics.persistent_homology import analysis, distances
+
+class TestDistances(unittest.TestCase):
+    def setUp(self):
+        self.ph1 = np.array([[0., 4.], [1., 2.]])
+        self.ph2 = np.array([[0., 5.]])
+        self.ph3 = np.array([[2., 2.], [3., 9.], [1., 4.]])
+
+    def test_bottleneck_distance(self):
+        """Test the bottleneck distance, the bar [1, 2] goes to the diagonal"""
+        self.assertEqual(distances.bottleneck_distance(self.ph1, self.ph2), 1.)
+        self.assertEqual(distances.bottleneck_distance(self.ph1, np.zeros((0, 2))), 2.)
+        self.assertEqual(distances.bottleneck_distance(self.ph1, self.ph1), 0.)
+
+    def test_wasserstein_distance(self):
+        """Test the Wasserstein distances of order 1 and 2"""
+        self.assertAlmostEqual(distances.wasserstein_distance(self.ph1, self.ph2), 1.5)
+        self.assertAlmostEqual(distances.wasserstein_distance(self.ph1, self.ph2, order=2), np.sqrt(1.25))
+
+    def test_distance_stepped(self):
+        """Test the stepped distance against the counts of bars of each interval"""
+        bins = np.array([0., 1., 2., 3., 4., 9.])
+        counts = lambda ph: np.array([sum(min(bar) <= hi and max(bar) > lo for bar in ph)
+                                      for lo, hi in zip(bins[:-1], bins[1:])])
+        expected = np.abs(counts(self.ph1) - counts(self.ph3)) * (bins[1:] + bins[:-1]) / 2
+        self.assertAlmostEqual(distances.distance_stepped(self.ph1, self.ph3), expected.sum())
+
+    def test_barcode_dist_matrix(self):
+        """Test the forms of the matrix and the reuse of the checkpointed blocks"""
+        barcodes = [self.ph1, self.ph2, self.ph3, self.ph1 + 1]
+        expected = [distances.wasserstein_distance(barcodes[i], barcodes[j])
+                    for i in range(4) for j in range(i + 1, 4)]
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            paired_dist = distances.get_barcode_dist_matrix(barcodes, "wd", block_size=2,
+                                                            checkpoint_dir=checkpoint_dir)
+            np.testing.assert_allclose(paired_dist, expected)
+            self.assertEqual(len(os.listdir(checkpoint_dir)), 3)
+
+            dist_matrix = distances.get_barcode_dist_matrix(barcodes, "wd", form="square", block_size=2,
+                                                            checkpoint_dir=checkpoint_dir)
+            np.testing.assert_allclose(dist_matrix, squareform(expected))
+
+            # Other kwargs or barcodes do not reuse the blocks
+            expected = [distances.wasserstein_distance(barcodes[i], barcodes[j], order=2)
+                        for i in range(4) for j in range(i + 1, 4)]
+            paired_dist = distances.get_barcode_dist_matrix(barcodes, "wd", block_size=2,
+                                                            checkpoint_dir=checkpoint_dir, order=2)
+            np.testing.assert_allclose(paired_dist, expected)
+            barcodes[3] = self.ph1 + 2
+            distances.get_barcode_dist_matrix(barcodes, "wd", block_size=2, checkpoint_dir=checkpoint_dir)
+            self.assertEqual(len(os.listdir(checkpoint_dir)), 9)
+
+        upper = distances.get_barcode_dist_matrix(barcodes, "sd", form="upper")
+        np.testing.assert_array_equal(np.tril(upper), np.zeros((4, 4)))
+
+    def test_matching_munkress_modified(self):
+        """Test the matching against all the permutations"""
+        indices, ssum = analysis.matching_munkress_modified(self.ph1, self.ph3)
+        p1 = np.concatenate([self.ph1, analysis._symmetric_points(self.ph3)])
+        p2 = np.concatenate([self.ph3, analysis._symmetric_points(self.ph1)])
+        D = np.linalg.norm(p1[:, None] - p2[None, :], axis=2)
+        self.assertAlmostEqual(ssum, min(D[range(5), list(perm)].sum() for perm in permutations(range(5))))
+        self.assertEqual(sorted(j for _, j in indices), list(range(5)))
+
+        indices, ssum = analysis.matching_munkress_modified(self.ph3, self.ph1, use_diag=False)
+        self.assertEqual(len(indices), 2)
+
+if __name__ == '__main__':
+    unittest.main()
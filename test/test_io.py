@@ -1,6 +1,13 @@
 import unittest
 import os
 import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from morphomics.io.io import read_swc
+from morphomics.io.swc import swc_to_neuron
+from morphomics.io import store
+from morphomics.cells.neuron.neuron import Neuron
 from morphomics.io.toml import load_toml, run_toml
 
 class TestIO(unittest.TestCase):
@@ -59,5 +66,100 @@ data_location_filepath = "test_data"
             
         os.unlink(f.name)
 
+class TestReadSWC(unittest.TestCase):
+    def _write_swc(self, content):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.swc', delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.unlink, f.name)
+        return f.name
+
+    def test_read_swc(self):
+        """Test parsing of a valid swc file"""
+        file_path = self._write_swc("# comment\n1 1 0 0 0 1.5 -1\r\n2 3 1.0 2 -3 .5 1\n\n")
+        swc_arr = read_swc(file_path)
+
+        expected = np.array([[1, 1, 0, 0, 0, 3, -1],
+                             [2, 3, 1, 2, -3, 1, 1]], dtype=float)
+        np.testing.assert_array_equal(swc_arr, expected)
+
+    def test_read_swc_skipped_lines(self):
+        """Test that malformed lines are skipped and reported"""
+        file_path = self._write_swc("1 1 0 0 0 1 -1\nfoo\n2 3 1 0 0 1 1\n3 3 x 0 0 1 2\n3 3 1 0 0 1 2 4\n")
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            swc_arr = read_swc(file_path)
+
+        self.assertEqual(swc_arr.shape, (2, 7))
+        self.assertEqual(len(w), 1)
+        self.assertIn("[2, 4, 5]", str(w[0].message))
+
+    def test_read_swc_short_file(self):
+        """Test that files with less than two points return nan"""
+        file_path = self._write_swc("# only one point\n1 1 0 0 0 1 -1\n")
+        self.assertTrue(np.isnan(read_swc(file_path)))
+
+class TestMorphoStore(unittest.TestCase):
+    def test_save_load_morphoframe(self):
+        """Test that the columnar store gives back the same morphoframe"""
+        swc_arr = np.array([[1, 1, 0, 0, 0, 2, -1],
+                            [2, 3, 1, 0, 0, 1, 1],
+                            [3, 3, 2, 1, 0, 1, 2],
+                            [4, 3, 2, -1, 0, 1, 2],
+                            [5, 2, 0, 1, 0, 1, 1],
+                            [6, 2, 0, 2, 0, 1, 5]], dtype=float)
+        morphoframe = pd.DataFrame({'file_name': ['a.swc', 'b.swc'],
+                                    'swc_array': pd.Series([swc_arr, np.nan], dtype=object),
+                                    'cells': pd.Series([swc_to_neuron(swc_arr), np.nan], dtype=object)})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = store.save_morphoframe(morphoframe, os.path.join(tmpdir, 'cells'))
+            self.assertTrue(store.is_morphostore(filepath))
+            loaded = store.load_morphoframe(filepath)
+
+            self.assertEqual(list(loaded.columns), list(morphoframe.columns))
+            self.assertEqual(list(loaded['file_name']), ['a.swc', 'b.swc'])
+            np.testing.assert_array_equal(loaded['swc_array'][0], swc_arr)
+            self.assertTrue(pd.isna(loaded['swc_array'][1]))
+            self.assertTrue(pd.isna(loaded['cells'][1]))
+
+            neuron, loaded_neuron = morphoframe['cells'][0], loaded['cells'][0]
+            self.assertTrue(neuron.soma.is_equal(loaded_neuron.soma))
+            self.assertEqual(len(neuron.neurites), len(loaded_neuron.neurites))
+            for tree, loaded_tree in zip(neuron.neurites, loaded_neuron.neurites):
+                self.assertTrue(tree.is_equal(loaded_tree))
+            del loaded, loaded_neuron
+
+    def test_store_access(self):
+        """Test the access to one cell at a time and the round-trip of a custom tree type mapping"""
+        swc_arr = np.array([[1, 1, 0, 0, 0, 2, -1],
+                            [2, 3, 1, 0, 0, 1, 1],
+                            [3, 3, 2, 0, 0, 1, 2],
+                            [4, 2, 0, 1, 0, 1, 1],
+                            [5, 2, 0, 2, 0, 1, 4]], dtype=float)
+        tree_type_dict = {1: "soma", 2: "glia_process", 3: "apical_dendrite"}
+        neuron = Neuron(name="custom", tree_type_dict=tree_type_dict)
+        for tree in swc_to_neuron(swc_arr).neurites:
+            neuron.append_tree(tree)
+        self.assertEqual((len(neuron.glia_process), len(neuron.apical_dendrite)), (1, 1))
+        morphoframe = pd.DataFrame({'file_name': ['a.swc', 'b.swc', 'c.swc'],
+                                    'cells': pd.Series([swc_to_neuron(swc_arr), np.nan, neuron], dtype=object)})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = store.save_morphoframe(morphoframe, os.path.join(tmpdir, 'cells'))
+            morpho_store = store.MorphoStore(filepath)
+            self.assertEqual(len(morpho_store), 3)
+            self.assertIs(morpho_store[1], np.nan)
+            loaded_neuron = morpho_store[2]
+            self.assertEqual(loaded_neuron.tree_type_dict, tree_type_dict)
+            self.assertEqual((len(loaded_neuron.glia_process), len(loaded_neuron.apical_dendrite)), (1, 1))
+            self.assertEqual(len(morpho_store[0].basal_dendrite), 1)
+            self.assertEqual([cell is np.nan for cell in morpho_store], [False, True, False])
+
+            row = morpho_store.get_row(2)
+            self.assertEqual(row['file_name'], 'c.swc')
+            self.assertEqual(row['cells'].name, 'custom')
+            self.assertEqual(list(store.load_morphoframe(filepath, columns=['file_name']).columns), ['file_name'])
+            del morpho_store, loaded_neuron, row
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,37 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from morphomics.cells.population.population import Population
+
+class TestPopulation(unittest.TestCase):
+    def test_failed_files_with_workers(self):
+        """Test that the files that fail to load in worker processes are np.nan"""
+        swc_files = sorted(glob.glob("examples/data/S1/*/*/*/*corrected.swc"))[:3]
+        with tempfile.TemporaryDirectory() as folder:
+            os.makedirs(os.path.join(folder, "A"))
+            for i, swc_file in enumerate(swc_files):
+                shutil.copy(swc_file, os.path.join(folder, "A", "cell_%d.swc" % i))
+            with open(os.path.join(folder, "A", "corrupt.swc"), "w") as f:
+                f.write("not a swc file\n1 2 3\n")
+
+            with mock.patch("os.cpu_count", return_value=4):
+                population = Population(folder_path=folder, conditions=["Animal"], n_jobs=2)
+
+        is_corrupt = population.cells["file_name"] == "corrupt.swc"
+        self.assertEqual(is_corrupt.sum(), 1)
+        self.assertIs(population.cells["swc_array"][is_corrupt].iloc[0], np.nan)
+        self.assertIs(population.cells["cells"][is_corrupt].iloc[0], np.nan)
+
+        population.exclude_sg_branches()
+        population.simplify()
+        population.combine_neurites()
+        population.set_cells()
+        self.assertIs(population.cells["trees"][is_corrupt].iloc[0], np.nan)
+        self.assertEqual(population.cells["cells"].apply(lambda cell: cell is not np.nan).sum(), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+import numpy as np
+import pandas as pd
+from morphomics.protocols import subsampler
+
+class TestSubsampler(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.phs = pd.Series([np.sort(rng.random((n, 2)), axis=1) for n in (5, 8, 3)])
+
+    def test_subsample_phs_reproducible(self):
+        """Test that the subsampled barcodes are the same for a seed and are made of the barcode bars"""
+        probas = subsampler.set_proba(self.phs)
+        subsampled = subsampler.subsample_phs_w_replacement(self.phs, probas, 0.5, 4, rand_seed=3)
+        again = subsampler.subsample_phs_w_replacement(self.phs, probas, 0.5, 4, rand_seed=3)
+        for ph, samples, samples_again in zip(self.phs, subsampled, again):
+            self.assertEqual(len(samples), 4)
+            for sample, sample_again in zip(samples, samples_again):
+                np.testing.assert_array_equal(sample, sample_again)
+                self.assertEqual(len(sample), max(1, int(0.5 * len(ph))))
+                self.assertTrue(all(np.any(np.all(ph == bar, axis=1)) for bar in sample))
+
+    def test_main_branches(self):
+        """Test that the main branches are kept in every subsample and never drawn"""
+        phs = pd.Series([np.array([[0., 5.], [1., 2.], [2., 4.]]), np.array([[0., 3.]])])
+        probas = subsampler.set_proba(phs, main_branches='keep')
+        np.testing.assert_allclose(probas[0], [0., 1. / 3, 2. / 3])
+        np.testing.assert_array_equal(probas[1], [0.])
+
+        subsampled = subsampler.subsample_phs_w_replacement(phs, probas, 2, 3, rand_seed=0, main_branches='keep')
+        for sample in subsampled[0]:
+            self.assertEqual(len(sample), 3)
+            np.testing.assert_array_equal(sample[-1], [0., 5.])
+            self.assertFalse(np.any(sample[:2, 0] == 0.))
+        for sample in subsampled[1]:
+            np.testing.assert_array_equal(sample, [[0., 3.]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+import numpy as np
+from morphomics.cells.neuron.neuron import Neuron
+from morphomics.cells.tree.tree import Tree
+from morphomics.persistent_homology import tmd
+
+class TestTMD(unittest.TestCase):
+    def setUp(self):
+        # Root with one child that bifurcates in two leaves, then a second trunk.
+        #       3
+        #       |
+        # 0 --- 1 --- 2
+        #  \
+        #   4 --- 5
+        self.tree = Tree(x=[0, 1, 2, 1, -1, -2],
+                         y=[0, 0, 0, 3, 0, 0],
+                         z=[0, 0, 0, 0, 0, 0],
+                         d=[1, 1, 1, 1, 1, 1],
+                         t=[3, 3, 3, 3, 3, 3],
+                         p=[-1, 0, 1, 1, 0, 4])
+
+    def test_tree_to_property_barcode(self):
+        """Test the barcode and the points of each bar"""
+        ph, bars_to_points = tmd.tree_to_property_barcode(self.tree,
+                                                          tmd._filtration_function('radial_distance'))
+
+        expected = np.array([[2, 1],
+                             [2, 0],
+                             [np.sqrt(10), 0]])
+        np.testing.assert_allclose(ph, expected, rtol=1e-6)
+        self.assertEqual([list(points) for points in bars_to_points], [[2], [5], [3, 1, 0]])
+
+    def test_single_trunk(self):
+        """Test a tree made of a single section"""
+        tree = Tree(x=[0, 1, 2], y=[0, 0, 0], z=[0, 0, 0], d=[1, 1, 1], t=[3, 3, 3], p=[-1, 0, 1])
+        ph, bars_to_points = tmd.tree_to_property_barcode(tree, tmd._filtration_function('path_distance'))
+
+        np.testing.assert_allclose(ph, [[2, 0]])
+        self.assertEqual([list(points) for points in bars_to_points], [[2]])
+
+    def test_get_ph_batch(self):
+        """Test that the batch keeps the order of the cells and captures the failures"""
+        neuron = Neuron()
+        neuron.append_tree(self.tree)
+        cells = [self.tree, np.nan, Neuron(), neuron]
+        phs, errors = tmd.get_ph_batch(cells, feature='radial_distance', chunksize=2)
+
+        expected = tmd.get_persistence_diagram(self.tree)
+        self.assertEqual(len(phs), len(cells))
+        np.testing.assert_array_equal(phs[0], expected)
+        np.testing.assert_array_equal(phs[3], expected)
+        self.assertTrue(np.isnan(phs[1]))
+        self.assertTrue(np.isnan(phs[2]))
+        self.assertEqual(list(errors.keys()), [2])
+
+        # The failed cells are np.nan with worker processes too
+        with mock.patch("os.cpu_count", return_value=4):
+            phs, errors = tmd.get_ph_batch(cells, feature='radial_distance', n_jobs=2, chunksize=1)
+        np.testing.assert_array_equal(phs[3], expected)
+        self.assertIs(phs[1], np.nan)
+        self.assertIs(phs[2], np.nan)
+        self.assertEqual(list(errors.keys()), [2])
+
+if __name__ == '__main__':
+    unittest.main()
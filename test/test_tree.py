@@ -0,0 +1,125 @@
+import gc
+import pickle
+import unittest
+import weakref
+import numpy as np
+from morphomics.cells.tree.tree import Tree, simplify_trees
+
+class TestTree(unittest.TestCase):
+    def setUp(self):
+        # Root with one child that bifurcates in two leaves, then a second trunk.
+        #       3
+        #       |
+        # 0 --- 1 --- 2
+        #  \
+        #   4 --- 5
+        self.tree = Tree(x=[0, 1, 2, 1, -1, -2],
+                         y=[0, 0, 0, 3, 0, 0],
+                         z=[0, 0, 0, 0, 0, 0],
+                         d=[1, 1, 1, 1, 1, 1],
+                         t=[3, 3, 3, 3, 3, 3],
+                         p=[-1, 0, 1, 1, 0, 4])
+
+    def test_parents_children(self):
+        """Test the section and edge dictionnaries"""
+        children_to_parents, parents_to_children = self.tree.parents_children()
+        self.assertEqual(children_to_parents, {1: 0, 2: 1, 3: 1, 5: 0, 0: -1})
+        self.assertEqual(list(parents_to_children), [0, 1])
+        np.testing.assert_array_equal(parents_to_children[0], [1, 5])
+        np.testing.assert_array_equal(parents_to_children[1], [2, 3])
+
+        children_to_parents, parents_to_children = self.tree.parents_children(edges=True)
+        self.assertEqual(children_to_parents, {1: 0, 2: 1, 3: 1, 4: 0, 5: 4, 0: -1})
+        np.testing.assert_array_equal(parents_to_children[0], [1, 4])
+
+    def test_children(self):
+        """Test the CSR children and the topological order"""
+        topology = self.tree.topology
+        np.testing.assert_array_equal(topology.children_ptr, [0, 2, 4, 4, 4, 5, 5])
+        np.testing.assert_array_equal(topology.children_idx, [1, 4, 2, 3, 5])
+        np.testing.assert_array_equal(topology.depth, [0, 1, 2, 2, 1, 2])
+        self.assertEqual([list(level) for level in topology.levels], [[0], [1, 4], [2, 3, 5]])
+        np.testing.assert_array_equal(self.tree.get_children()[1], [2, 3])
+        np.testing.assert_array_equal(self.tree.get_node_children_number(), [2, 2, 0, 0, 1, 0])
+
+    def test_ways(self):
+        """Test the ways to the root and their orders"""
+        self.assertEqual(self.tree.get_way_to_root(3), [3, 1, 0])
+        self.assertEqual(self.tree.get_all_ways(), [[0, 1, 2], [0, 1, 3], [0, 4, 5]])
+        np.testing.assert_array_equal(self.tree.get_nodes_way_order(), [1, 2, 2, 2, 1, 1])
+        self.assertAlmostEqual(self.tree.get_way_length(3), 1 + 3)
+        self.assertEqual(self.tree.get_way_length(0), 0)
+        np.testing.assert_allclose(self.tree.get_sections_length(), [1, 1, 3, 2])
+
+    def test_simplify(self):
+        """Test the skeleton of the tree, alone and in a batch"""
+        simplified = self.tree.simplify()
+        np.testing.assert_array_equal(simplified.x, [0, 1, 2, 1, -2])
+        np.testing.assert_array_equal(simplified.p, [-1, 0, 1, 1, 0])
+
+        single_node = Tree(x=[0], y=[0], z=[0], d=[1], t=[3], p=[-1])
+        batch = simplify_trees([self.tree, single_node, self.tree])
+        self.assertIs(batch[1], single_node)
+        for tree in (batch[0], batch[2]):
+            self.assertTrue(tree.is_equal(simplified))
+
+    def test_view(self):
+        """Test that a view shares the arrays and the topology but cannot modify them"""
+        view = self.tree.view()
+        self.assertTrue(np.shares_memory(view.x, self.tree.x))
+        self.assertIs(view.topology, self.tree.topology)
+        with self.assertRaises(ValueError):
+            view.x[0] = 10
+        view.move_to_point((1, 1, 1))
+        self.assertEqual(view.x[0], 1)
+        self.assertEqual(self.tree.x[0], 0)
+
+    def test_copy(self):
+        """Test that a tree copies its arrays, unless it is built with copy=False"""
+        x = np.zeros(6, dtype=np.float32)
+        tree = Tree(x, self.tree.y, self.tree.z, self.tree.d, self.tree.t, self.tree.p)
+        self.assertFalse(np.shares_memory(tree.x, x))
+        rotated = self.tree.rotate_xy(np.pi / 2)
+        for col in "zdtp":
+            self.assertFalse(np.shares_memory(getattr(rotated, col), getattr(self.tree, col)))
+        tree = Tree(x, self.tree.y, self.tree.z, self.tree.d, self.tree.t, self.tree.p, copy=False)
+        self.assertIs(tree.x, x)
+
+    def test_subsample_tree(self):
+        """Test the pruning and the cut of the leaves"""
+        pruned = self.tree.subsample_tree('prune', 1)
+        np.testing.assert_array_equal(pruned.x, [0, 1, -1])
+        np.testing.assert_array_equal(pruned.p, [-1, 0, 0])
+
+        cut = self.tree.subsample_tree('cut', 1)
+        np.testing.assert_array_equal(cut.x, [0, 1, -1, -2])
+        np.testing.assert_array_equal(cut.p, [-1, 0, 0, 2])
+
+        self.assertIsNone(self.tree.subsample_tree('prune', 5))
+
+    def test_topology_freed_with_tree(self):
+        """Test that the cached topology does not keep the tree alive"""
+        self.tree.parents_children()
+        tree_ref = weakref.ref(self.tree)
+        del self.tree
+        gc.collect()
+        self.assertIsNone(tree_ref())
+
+    def test_topology_invalidated(self):
+        """Test that reassigning the parents recomputes the topology"""
+        beg, end = self.tree.sections
+        np.testing.assert_array_equal(end, [1, 2, 3, 5])
+        self.tree.p = np.array([-1, 0, 1, 2, 3, 4])
+        beg, end = self.tree.sections
+        np.testing.assert_array_equal(beg, [0])
+        np.testing.assert_array_equal(end, [5])
+
+    def test_pickle_drops_topology(self):
+        """Test that the topology is not pickled but rebuilt"""
+        self.tree.parents_children()
+        tree = pickle.loads(pickle.dumps(self.tree))
+        self.assertNotIn("_topology", tree.__dict__)
+        np.testing.assert_array_equal(tree.sections[1], self.tree.sections[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import numpy as np
+from morphomics.persistent_homology import vectorizations
+
+class TestVectorizations(unittest.TestCase):
+    def setUp(self):
+        self.ph = np.array([[10., 2.],
+                            [6., 0.],
+                            [4., 3.],
+                            [8., 8.]])
+
+    def test_persistence_image_isotropic(self):
+        """Test the separable isotropic image against the sum of 2D gaussians"""
+        std, weights = 1.5, np.array([1., 0.5, 2., 1.])
+        xs, ys = np.linspace(0, 12, 20), np.linspace(-1, 9, 20)
+        image = vectorizations.persistence_image(self.ph, method="isotropic", std_isotropic=std,
+                                                 xlim=(0, 12), ylim=(-1, 9), weights=weights,
+                                                 resolution=20, chunk_size=3)
+
+        X, Y = np.meshgrid(xs, ys, indexing="ij")
+        expected = sum(w * np.exp(-((X - b) ** 2 + (Y - d) ** 2) / (2 * std**2))
+                       for (b, d), w in zip(self.ph, weights)) / (2 * np.pi * std**2)
+        np.testing.assert_allclose(image, expected, rtol=1e-10)
+
+    def test_persistence_images(self):
+        """Test the batch of flattened and normalized images"""
+        ph_list = [self.ph, self.ph[:2] + 1]
+        images = vectorizations.persistence_images(ph_list, method="isotropic", std_isotropic=1.,
+                                                   xlim=(0, 12), ylim=(-1, 9), resolution=10, norm_method="max")
+        self.assertEqual(images.shape, (2, 100))
+        self.assertEqual(images.dtype, np.float32)
+        for image, ph in zip(images, ph_list):
+            expected = vectorizations.persistence_image(ph, method="isotropic", std_isotropic=1.,
+                                                        xlim=(0, 12), ylim=(-1, 9), resolution=10).ravel()
+            np.testing.assert_allclose(image, expected / expected.max(), rtol=1e-6)
+
+    def test_curves(self):
+        """Test the curves at the bar ends and between them"""
+        t_list = np.array([-1., 0., 2., 3., 5., 8., 10., 11.])
+        betti, _ = vectorizations.betti_curve(self.ph, t_list=t_list)
+        expected = [sum(min(bar) <= t <= max(bar) for bar in self.ph) for t in t_list]
+        np.testing.assert_array_equal(betti, expected)
+
+        lifespan, _ = vectorizations.lifespan_curve(self.ph, t_list=t_list)
+        lengths = np.abs(np.sort(self.ph[:, 1] - self.ph[:, 0]))
+        expected = [sum(l for bar, l in zip(self.ph, lengths) if min(bar) <= t <= max(bar)) for t in t_list]
+        np.testing.assert_allclose(lifespan, expected)
+
+        entropy, _ = vectorizations.life_entropy_curve(self.ph[:3], t_list=t_list)
+        z = np.abs(self.ph[:3, 1] - self.ph[:3, 0]) / 15.
+        expected = [-sum(e for bar, e in zip(self.ph[:3], z * np.log(z)) if min(bar) <= t <= max(bar)) for t in t_list]
+        np.testing.assert_allclose(entropy, expected)
+
+    def test_hists(self):
+        """Test the histograms of one barcode and of a batch of barcodes"""
+        bins = vectorizations._subintervals([0, 10], num_bins=5)
+        betti, _ = vectorizations.betti_hist(self.ph, bins=bins)
+        expected = [sum(min(bar) < hi and lo < max(bar) for bar in self.ph) for lo, hi in bins]
+        np.testing.assert_array_equal(betti, expected)
+
+        lifespan, _ = vectorizations.lifespan_hist(self.ph, bins=bins)
+        lengths = np.abs(np.sort(self.ph[:, 1] - self.ph[:, 0]))
+        expected = [sum(l for bar, l in zip(self.ph, lengths) if min(bar) < hi and lo < max(bar)) for lo, hi in bins]
+        np.testing.assert_allclose(lifespan, expected)
+
+        ph_list = [self.ph, self.ph[:1], self.ph[1:] + 2]
+        np.testing.assert_array_equal(vectorizations.betti_hists(ph_list, bins),
+                                      [vectorizations.betti_hist(ph, bins=bins)[0] for ph in ph_list])
+        np.testing.assert_allclose(vectorizations.lifespan_hists(ph_list, bins),
+                                   [vectorizations.lifespan_hist(ph, bins=bins)[0] for ph in ph_list])
+
+    def test_stable_ranks(self):
+        """Test the stable ranks of a batch of barcodes, with and without bar probabilities"""
+        lengths_list = [np.array([1., 2., 2., 5.]), np.zeros(0), np.array([3., 4.])]
+        x_values = np.linspace(0, 5, 6)
+        ranks = vectorizations.stable_ranks_batch(lengths_list, False, 5, 6)
+        np.testing.assert_array_equal(ranks, [[np.count_nonzero(l >= x) for x in x_values] for l in lengths_list])
+
+        weighted = vectorizations.stable_ranks_batch(lengths_list, "long", 5, 6)
+        expected = [[len(l) * (l[l >= x] / l.sum()).sum() for x in x_values] for l in lengths_list]
+        np.testing.assert_allclose(weighted, np.array(expected))
+
+        short = vectorizations.stable_ranks(lengths_list[0], "short", 5, 6)
+        prob = (5. - lengths_list[0]) / (5. - lengths_list[0]).sum()
+        np.testing.assert_allclose(short, [4 * prob[lengths_list[0] >= x].sum() for x in x_values])
+
+if __name__ == '__main__':
+    unittest.main()